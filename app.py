@@ -1,8 +1,16 @@
-from flask import Flask, request, render_template, redirect, flash, session, jsonify, g
+from flask import Flask, request, render_template, redirect, flash, session, jsonify, g, make_response
 from flask_debugtoolbar import DebugToolbarExtension
 from user import db, connect_db, User
-from search import Search
-from forms import RegisterForm, LoginForm, SearchForm, UserEditForm, ChangePwdForm, PasswordForm
+from search import Search, BATCH_MAX_ITEMS
+from cache import cache_stats, configure_caches
+from cache_backends import make_backend
+from identity import CurrentUser, forget_user
+from hashing import HashQueueFull, hash_stats
+from throttle import login_throttle, throttle_stats
+from responses import compress_response, conditional
+from upstream import upstream_stats, is_error
+from forms import RegisterForm, LoginForm, SearchForm, UserEditForm, ChangePwdForm, PasswordForm, RADIUS_CHOICES
+import json
 import os
 
 CURR_USER_KEY = "curr_user"
@@ -15,8 +23,22 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = True
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "def_key")
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['PREFETCH_UPSTREAM'] = os.environ.get('PREFETCH_UPSTREAM', '') == '1'
+# fetch forecast and top routes concurrently while rendering /search results
+app.config['COMPRESS_RESPONSES'] = os.environ.get('COMPRESS_RESPONSES', '1') == '1'
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+# memory (per worker), sqlite (per machine) or network (shared, see cache_server.py)
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+# sqlite file path or network host:port
+app.config['CACHE_SERIALIZER'] = os.environ.get('CACHE_SERIALIZER', 'json')
+app.config['CACHE_NAMESPACES'] = json.loads(os.environ.get('CACHE_NAMESPACES', '{}'))
+# per cache overrides, e.g. {"hikes": {"ttl": 3600, "max_entries": 500}}
 debug = DebugToolbarExtension(app)
 
+configure_caches(make_backend(app.config['CACHE_BACKEND'], app.config['CACHE_URL'],
+                              app.config['CACHE_SERIALIZER']),
+                 app.config['CACHE_NAMESPACES'])
+
 connect_db(app)
 
 # error handling and setup g.user #####################
@@ -28,6 +50,15 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(HashQueueFull)
+def hashing_busy(e):
+    """Too many password checks queued, turn this one away before hashing"""
+
+    flash('Too many login attempts right now, please try again in a moment')
+    return redirect(request.path, code=303)
+    # only password routes hash, so only they get turned away
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
@@ -35,11 +66,37 @@ def add_user_to_g():
     if CURR_USER_KEY in session:
         # g.user is used throughout app to control access to routes
         # and to access information on the currently logged in user
-        g.user = User.query.get(session[CURR_USER_KEY])
+        # it only hits the db when something other than g.user.id is needed
+        g.user = CurrentUser(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
+
+def load_user_row():
+    """Returns the logged in user's row, logs out if the account is gone
+
+    Cached identities can outlive an account deleted on another worker,
+    routes that need the real row use this instead of trusting g.user"""
+
+    user = g.user.load()
+    if user is None:
+        session.pop(CURR_USER_KEY, None)
+        g.user = None
+
+    return user
+
+
+@app.after_request
+def compress(response):
+    """gzip/brotli large html and json responses"""
+
+    if app.config['COMPRESS_RESPONSES'] and not app.debug:
+        # debug toolbar rewrites html after this runs, can't be compressed
+        return compress_response(response)
+
+    return response
+
 # User Routes ##########################################
 
 @app.route('/')
@@ -81,6 +138,9 @@ def register():
                 username, password, first_name, last_name, email, is_admin)
             db.session.add(new_user)
             db.session.commit()
+        except HashQueueFull:
+            raise
+            # hashing_busy shows 'try again', not 'already taken'
         except:
             db.session.rollback()
             flash('Username or email already taken')
@@ -110,6 +170,11 @@ def login():
         username = form.username.data
         password = form.password.data
 
+        if not login_throttle.allow(request.remote_addr, username):
+            # checked before authenticate so throttled attempts cost no bcrypt
+            form.username.errors = ['Too many attempts, please wait a minute']
+            return render_template('login.html', form=form), 429
+
         logged_user = User.authenticate(username, password)
         if logged_user:
             session[CURR_USER_KEY] = logged_user.id
@@ -161,11 +226,19 @@ def edit_profile():
         flash("Please Register First")
         return redirect("/")
 
-    user = User.query.filter_by(id=g.user.id).first()
+    user = load_user_row()
+    if user is None:
+        flash("Please Register First")
+        return redirect("/")
+
     form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
         
+        if not login_throttle.allow(request.remote_addr, user.username):
+            flash('Too many attempts, please wait a minute')
+            return render_template('edit.html', user=user, form=form), 429
+
         entered_pass = form.password.data
         correct_password = user.check_password(entered_pass)
         # if correct_password = False then entered pwd was wrong
@@ -180,6 +253,7 @@ def edit_profile():
 
         try:
             user.edit_user(username, first_name, last_name, email)
+            forget_user(user.id)
             flash('Profile Info Edited')
             return redirect(f'/users/{user.id}')
         except:
@@ -198,10 +272,18 @@ def change_password():
         flash("Please Register First")
         return redirect("/")
 
-    user = User.query.filter_by(id=g.user.id).first()
+    user = load_user_row()
+    if user is None:
+        flash("Please Register First")
+        return redirect("/")
+
     form = ChangePwdForm()
 
     if form.validate_on_submit():
+        if not login_throttle.allow(request.remote_addr, user.username):
+            flash('Too many attempts, please wait a minute')
+            return render_template('password.html', user=user, form=form), 429
+
         old_password = form.old_password.data
         correct_password = user.check_password(old_password)
 
@@ -213,8 +295,11 @@ def change_password():
 
         try:
             user.change_password(new_password)
+            forget_user(user.id)
             flash('Password Changed')
             return redirect(f'/users/{user.id}')
+        except HashQueueFull:
+            raise
         except:
             db.session.rollback()
             flash('Password Not changed (error)')
@@ -231,12 +316,21 @@ def delete_user():
         flash("Please Register First")
         return redirect("/")
 
+    user = load_user_row()
+    if user is None:
+        flash("Please Register First")
+        return redirect("/")
+
     form = PasswordForm()
 
     if form.validate_on_submit():
         password = form.password.data    
 
-        correct_password = g.user.check_password(password)
+        if not login_throttle.allow(request.remote_addr, user.username):
+            flash('Too many attempts, please wait a minute')
+            return render_template('delete.html', form=form), 429
+
+        correct_password = user.check_password(password)
 
         if not correct_password:
             flash('Incorrect Password')
@@ -245,8 +339,9 @@ def delete_user():
         if CURR_USER_KEY in session:
             del session[CURR_USER_KEY]
 
-        db.session.delete(g.user)
+        db.session.delete(user)
         db.session.commit()
+        forget_user(user.id)
 
         flash('Account Deleted')
         return redirect("/register")
@@ -257,9 +352,20 @@ def delete_user():
 def show_admin_panel():
     """Allows admin users to delete other users"""
 
-    users = User.query.all()
+    if not g.user:
+        flash("Please Register First")
+        return redirect("/register")
+
+    if g.user.is_admin != True:
+        flash("Must be an admin")
+        return redirect("/search")
+
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+    prefix = request.args.get('q', '').strip()
+    listing = User.admin_listing(per_page, after_id=request.args.get('after', type=int),
+                                 prefix=prefix)
 
-    return render_template('admin.html', users=users)    
+    return render_template('admin.html', listing=listing, prefix=prefix, per_page=per_page)
 
 @app.route('/admin/delete/<int:user_id>', methods=["POST"])   
 def admin_delete_user(user_id):
@@ -277,9 +383,26 @@ def admin_delete_user(user_id):
 
     db.session.delete(user)
     db.session.commit()
+    forget_user(user_id)
 
     return redirect('/admin')        
 
+
+@app.route('/admin/stats')
+def show_cache_stats():
+    """Shows cache, password hashing, throttle and upstream counters for this worker"""
+
+    if not g.user:
+        flash("Please Register First")
+        return redirect("/register")
+
+    if g.user.is_admin != True:
+        flash("Must be an admin")
+        return redirect("/search")
+
+    return jsonify(caches=cache_stats, hashing=hash_stats, throttle=throttle_stats,
+                   upstream=upstream_stats)
+
    
 
 # Search Routes ########################################
@@ -292,8 +415,7 @@ def find_hikes():
         return redirect("/")
 
     form = SearchForm()
-    form.radius.choices = [(5000, 3), (8000, 5), (12500, 8),
-                           (16000, 10), (24000, 15), (32000, 20)]
+    form.radius.choices = RADIUS_CHOICES
 
     if request.method == "GET":
         # This is for searches originating from /search/past route
@@ -307,37 +429,79 @@ def find_hikes():
         coords = Search.get_coords(address)
         radius = form.radius.data
 
+        if coords is None:
+            flash('Could not look up that address, check it or try again in a moment')
+            return render_template('search.html', form=form)
+
         raw_results = Search.get_hikes(coords, radius)
+        if raw_results.get('status') not in ('OK', 'ZERO_RESULTS'):
+            flash('Hike search is unavailable right now, please try again in a moment')
+            return render_template('search.html', form=form)
+            # upstream down or over quota, nothing is saved
         # json has to be parsed into the data we want
         # weather.txt contains example json response
         hikes = Search.show_search_results(raw_results)
 
-        for hike in hikes:
-            # take data from previous step and create instances of Search object with it
-            hike_search = Search(user_id=g.user.id, name=hike.name, address=address,
-                                 radius=radius, place_id=hike.place_id, timestamp=None)
-            try:
-                db.session.add(hike_search)
-                db.session.commit()
+        Search.save_results(g.user.id, address, radius, coords, hikes)
+        # one insert/commit for the whole result set instead of one per hike
 
-            except:
-                db.session.rollback()
+        routes = {}
+        if app.config['PREFETCH_UPSTREAM'] and hikes:
+            # warms forecast/directions caches so the follow-up clicks are local
+            routes = Search.prefetch(coords, address, hikes)['routes']
 
-        return render_template('search.html', form=form, hikes=hikes, address=address, coords=coords)
+        return render_template('search.html', form=form, hikes=hikes, address=address, coords=coords,
+                               routes=routes)
 
     return render_template('search.html', form=form)
+    # no etag, the csrf token makes every render different
 
 
-@app.route('/search/details', methods=["POST"])
+@app.route('/search/details', methods=["GET", "POST"])
 def return_directions():
     """Receives request from front-end and responds with hikes"""
 
-    destination_id = request.json['destination_id']
-    origin_address = request.json['origin_address']
+    if request.method == "GET":
+        # GET so the browser can revalidate with If-None-Match
+        data = request.args
+    else:
+        data = request.json
+
+    destination_id = data['destination_id']
+    origin_address = data['origin_address']
 
     directions = Search.get_directions(origin_address, destination_id)
 
-    return jsonify(directions)
+    if is_error(directions):
+        return jsonify(directions), 502
+        # never a 304, the next click should retry
+
+    return conditional(jsonify(directions))
+
+
+@app.route('/search/details/batch', methods=["POST"])
+def return_directions_batch():
+    """Returns directions from one origin to many hikes in one response"""
+
+    if not g.user:
+        flash("Please Register First")
+        return redirect("/")
+        # every id is a billable Directions call, only for logged in users
+
+    data = request.get_json(silent=True) or {}
+    origin_address = data.get('origin_address')
+    destination_ids = data.get('destination_ids')
+
+    if (not isinstance(origin_address, str) or not isinstance(destination_ids, list)
+            or not all(isinstance(place_id, str) for place_id in destination_ids)):
+        return jsonify(error='expected origin_address and a list of destination_ids'), 400
+
+    if len(destination_ids) > BATCH_MAX_ITEMS:
+        return jsonify(error=f'at most {BATCH_MAX_ITEMS} destination_ids per batch'), 400
+
+    results, errors = Search.get_directions_batch(origin_address, destination_ids)
+
+    return jsonify(results=results, errors=errors)
 
 
 @app.route('/search/past', methods=["GET", "POST"])
@@ -348,19 +512,42 @@ def get_past_searches():
         flash("Please Register First")
         return redirect("/register")
 
-    past_searches = Search.query.filter_by(user_id=g.user.id).limit(1000).all()
-    sorted_searches = Search.sort_searches(past_searches)
-    # Gets all searches from user then sorts into unique searches ordered by date
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    page = Search.past_searches_page(g.user.id, per_page,
+                                     before=request.args.get('before'),
+                                     after=request.args.get('after'))
+    # database dedupes to unique address/radius searches, newest first
 
-    return render_template('past.html', past_searches=past_searches, sorted_searches=sorted_searches)
+    response = make_response(render_template('past.html', past_searches=page['searches'],
+                                             page=page, per_page=per_page))
+    return conditional(response, last_modified=Search.last_searched(g.user.id))
 
 
-@app.route('/search/forecast', methods=["POST"])
+@app.route('/search/forecast', methods=["GET", "POST"])
 def return_forecast():
     """Receives coords from frontend and returns 5-day forecast"""
 
-    coords_str = request.json['coords']
-    coords = eval(coords_str)
+    if request.method == "GET":
+        # GET so the browser can revalidate with If-None-Match
+        data = {'lat': request.args.get('lat', type=float),
+                'lng': request.args.get('lng', type=float),
+                'daily': request.args.get('daily') == '1'}
+    else:
+        data = request.get_json(silent=True)
+
+    try:
+        coords = Search.parse_coords(data)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+        # bad input never reaches OpenWeather
+
     forecast = Search.get_forecast(coords)
 
-    return jsonify(forecast)
+    if is_error(forecast):
+        return jsonify(forecast), 502
+
+    if data.get('daily') and 'slots' in forecast:
+        # optional per-day summary instead of every 3 hour slot
+        forecast = {'city': forecast['city'], 'days': Search.daily_rollup(forecast['slots'])}
+
+    return conditional(jsonify(forecast))
@@ -0,0 +1,48 @@
+"""Benchmark for choosing BCRYPT_LOG_ROUNDS.
+
+Reports bcrypt hashes/sec on one core for each cost, login throughput per
+core is roughly the same number since a check costs the same as a hash.
+
+run like:
+
+   python bench_bcrypt.py                 # costs 10-14
+   python bench_bcrypt.py 4 6 8 12        # specific costs
+"""
+
+import os
+import sys
+import time
+
+import hashing
+
+DEFAULT_COSTS = [10, 11, 12, 13, 14]
+MIN_SECONDS = 2
+# keep hashing each cost for at least this long for a stable number
+
+
+def hashes_per_second(cost):
+    count = 0
+    start = time.perf_counter()
+
+    while True:
+        hashing._generate('benchmark-password', cost)
+        # what the app runs, bcrypt.hashpw with gensalt(cost), minus the slot/pool
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_SECONDS and count >= 3:
+            return count / elapsed
+
+
+def main():
+    costs = [int(cost) for cost in sys.argv[1:]] or DEFAULT_COSTS
+
+    print(f'cores available: {os.cpu_count()}')
+    print(f'{"cost":>4}  {"hashes/sec/core":>15}  {"ms/hash":>8}')
+
+    for cost in costs:
+        rate = hashes_per_second(cost)
+        print(f'{cost:>4}  {rate:>15.2f}  {1000 / rate:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
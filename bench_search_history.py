@@ -0,0 +1,95 @@
+"""Benchmark for saving search history.
+
+Compares the old commit-per-hike loop against Search.save_results.
+
+run like:
+
+   python bench_search_history.py > bench_output.txt
+
+Uses DATABASE_URL (defaults to weather_test), tables are dropped/recreated.
+"""
+
+import os
+import time
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///weather_test")
+
+from sqlalchemy import event
+from user import db, User
+from search import Search, SearchResult
+from app import app
+
+app.config['SQLALCHEMY_ECHO'] = False
+
+SEARCHES = 50
+HIKES_PER_SEARCH = 20
+# nearbysearch returns at most 20 results
+
+COORDS = {'lat': 42.3292493, 'lng': -71.352353}
+
+commits = {'count': 0}
+
+
+@event.listens_for(db.session, 'after_commit')
+def count_commit(session):
+    commits['count'] += 1
+
+
+def make_hikes(n):
+    return [SearchResult(name=f'hike {i}', place_id=f'place_{i}') for i in range(n)]
+
+
+def save_per_row(user_id, address, radius, hikes):
+    """How find_hikes used to save results, one add/commit per hike"""
+
+    search = Search(user_id=user_id, address=address, radius=radius,
+                    lat=COORDS['lat'], lng=COORDS['lng'])
+    db.session.add(search)
+    db.session.commit()
+
+    for hike in hikes:
+        hike_result = SearchResult(run_id=search.id, name=hike.name, place_id=hike.place_id)
+        try:
+            db.session.add(hike_result)
+            db.session.commit()
+        except:
+            db.session.rollback()
+
+
+def save_batched(user_id, address, radius, hikes):
+    Search.save_results(user_id, address, radius, COORDS, hikes)
+
+
+def run(label, save, user_id):
+    commits['count'] = 0
+    timings = []
+
+    for i in range(SEARCHES):
+        hikes = make_hikes(HIKES_PER_SEARCH)
+        start = time.perf_counter()
+        save(user_id, f'{i} bench st', 5000, hikes)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    avg = sum(timings) / len(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+
+    print(f'{label:<12} commits/search: {commits["count"] / SEARCHES:>5.1f}   '
+          f'avg: {avg * 1000:>7.2f} ms   p95: {p95 * 1000:>7.2f} ms')
+
+
+def main():
+    db.drop_all()
+    db.create_all()
+
+    user = User.register('benchuser', 'password', 'Bench', 'User', 'bench@test.com', False)
+    db.session.add(user)
+    db.session.commit()
+
+    print(f'{SEARCHES} searches x {HIKES_PER_SEARCH} hikes')
+    run('per-row', save_per_row, user.id)
+    run('batched', save_batched, user.id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+from cache_backends import MemoryBackend
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from user import db
+import os
+import random
+import threading
+import time
+
+
+GEOCODE_TTL = int(os.environ.get('GEOCODE_CACHE_TTL', 60 * 60 * 24 * 30))
+# seconds, addresses almost never move so default is 30 days
+GEOCODE_MAX_ENTRIES = int(os.environ.get('GEOCODE_CACHE_SIZE', 10000))
+GEOCODE_TOUCH_INTERVAL = timedelta(hours=1)
+# last_used only gets rewritten once an hour so a cache hit isn't also a DB write
+
+REFRESH_WORKERS = int(os.environ.get('CACHE_REFRESH_WORKERS', 2))
+
+cache_stats = {
+    'geocode': {'hits': 0, 'misses': 0, 'evictions': 0}
+}
+
+caches = {}
+# name -> TTLCache, so configure_caches can reach every namespace
+default_backend = MemoryBackend()
+
+_refresh_executor = None
+_refresh_pid = None
+
+
+def get_refresh_executor():
+    """Returns this worker's pool for background cache refreshes"""
+
+    global _refresh_executor, _refresh_pid
+
+    if _refresh_executor is None or _refresh_pid != os.getpid():
+        _refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS,
+                                               thread_name_prefix='cache-refresh')
+        _refresh_pid = os.getpid()
+
+    return _refresh_executor
+
+
+def normalize_address(address):
+    """'  101 Loker  St ' and '101 loker st' should be the same key"""
+
+    return ' '.join(address.lower().split())
+
+
+class TTLCache:
+    """Cache with TTL expiry and LRU eviction, stored in a pluggable backend
+
+    Each cache is a namespace in its backend, see cache_backends.py. The
+    default backend is in-process so every worker has its own copy.
+
+    grace: seconds an expired value can still be served by get_or_fetch
+    while it's refreshed in the background (stale-while-revalidate)
+    jitter: ttls are cut by up to this fraction so keys set together
+    don't all expire together"""
+
+    def __init__(self, name, ttl, max_entries, grace=0, jitter=0, backend=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.grace = grace
+        self.jitter = jitter
+        self.backend = backend or default_backend
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.stats = cache_stats.setdefault(
+            name, {'hits': 0, 'misses': 0, 'evictions': 0, 'stale': 0, 'refreshes': 0})
+        caches[name] = self
+
+    def bump(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def lookup(self, key):
+        """Returns (value, is_stale), value is None if missing or past grace"""
+
+        entry = self.backend.get(self.name, key)
+
+        if entry is None:
+            self.bump('misses')
+            return None, False
+
+        expires_at, stale_until, value = entry
+        now = time.time()
+
+        if stale_until <= now:
+            self.backend.delete(self.name, key)
+            self.bump('misses')
+            return None, False
+
+        if expires_at <= now:
+            self.bump('stale')
+            return value, True
+
+        self.bump('hits')
+        return value, False
+
+    def get(self, key):
+        """Returns cached value or None if missing/expired"""
+
+        value, is_stale = self.lookup(key)
+        return None if is_stale else value
+
+    def get_or_fetch(self, key, fetch, ttl=None, should_cache=None):
+        """Returns cached value, calling fetch() on a miss
+
+        Stale values inside the grace window are returned right away and
+        fetch() runs on a background thread to replace them. ttl can be a
+        function so it's worked out when the value is stored"""
+
+        value, is_stale = self.lookup(key)
+
+        if value is not None:
+            if is_stale:
+                self.refresh(key, fetch, ttl, should_cache)
+            return value
+
+        return self.fetch_and_set(key, fetch, ttl, should_cache)
+
+    def fetch_and_set(self, key, fetch, ttl=None, should_cache=None):
+        value = fetch()
+
+        if value is not None and (should_cache is None or should_cache(value)):
+            if callable(ttl):
+                self.set(key, value, ttl(), jitter=False)
+                # computed ttls end on a boundary (forecast slots), jitter would
+                # expire them early and refetch the same data
+            else:
+                self.set(key, value, ttl)
+
+        return value
+
+    def refresh(self, key, fetch, ttl=None, should_cache=None):
+        """Refetches key on the background pool, once at a time per key"""
+
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+            self.stats['refreshes'] += 1
+
+        def run():
+            try:
+                self.fetch_and_set(key, fetch, ttl, should_cache)
+            except Exception:
+                pass
+                # stale value stays until its grace runs out, next request retries
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        get_refresh_executor().submit(run)
+
+    def set(self, key, value, ttl=None, jitter=True):
+        """Stores value for ttl seconds (defaults to the cache's ttl)
+
+        jitter=False keeps ttl exact"""
+
+        if ttl is None:
+            ttl = self.ttl
+
+        if self.jitter and jitter:
+            ttl = ttl * (1 - random.uniform(0, self.jitter))
+
+        expires_at = time.time() + ttl
+        evicted = self.backend.set(self.name, key, (expires_at, expires_at + self.grace, value),
+                                   self.max_entries)
+        if evicted:
+            self.bump('evictions', evicted)
+
+    def delete(self, key):
+        self.backend.delete(self.name, key)
+
+    def clear(self):
+        self.backend.clear(self.name)
+
+    def __len__(self):
+        return self.backend.count(self.name)
+
+
+def configure_caches(backend, namespaces=None):
+    """Points every TTLCache at backend, namespaces overrides per cache settings
+
+    namespaces looks like {'hikes': {'ttl': 3600, 'max_entries': 500}}"""
+
+    for name, cache in caches.items():
+        cache.backend = backend
+
+        for setting, value in (namespaces or {}).get(name, {}).items():
+            if setting not in ('ttl', 'max_entries', 'grace', 'jitter'):
+                raise ValueError(f'Unknown cache setting {setting} for {name}')
+            setattr(cache, setting, value)
+
+
+class GeocodeCache(db.Model):
+    """Stores address -> coords lookups so repeat searches skip Google"""
+
+    __tablename__ = 'geocode_cache'
+
+    address = db.Column(db.Text, primary_key=True)
+    lat = db.Column(db.Float, nullable=False)
+    lng = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    @classmethod
+    def normalize(cls, address):
+        return normalize_address(address)
+
+    @classmethod
+    def lookup(cls, address):
+        """Returns cached coords for an address or None if missing/expired"""
+
+        stats = cache_stats['geocode']
+        now = datetime.utcnow()
+
+        try:
+            entry = cls.query.get(cls.normalize(address))
+
+            if entry is None:
+                stats['misses'] += 1
+                return None
+
+            if entry.created_at + timedelta(seconds=GEOCODE_TTL) < now:
+                db.session.delete(entry)
+                db.session.commit()
+                stats['misses'] += 1
+                return None
+
+            if entry.last_used + GEOCODE_TOUCH_INTERVAL < now:
+                entry.last_used = now
+                db.session.commit()
+
+        except:
+            # cache problems should never break a search, just go to Google
+            db.session.rollback()
+            stats['misses'] += 1
+            return None
+
+        stats['hits'] += 1
+        return {'lat': entry.lat, 'lng': entry.lng}
+
+    @classmethod
+    def store(cls, address, coords):
+        """Saves coords for an address then evicts least recently used entries"""
+
+        now = datetime.utcnow()
+        entry = cls(address=cls.normalize(address), lat=coords['lat'], lng=coords['lng'],
+                    created_at=now, last_used=now)
+
+        try:
+            db.session.merge(entry)
+            db.session.commit()
+            cls.evict()
+        except:
+            db.session.rollback()
+
+    @classmethod
+    def evict(cls, max_entries=None):
+        """Deletes least recently used rows until table is under the size limit"""
+
+        if max_entries is None:
+            max_entries = GEOCODE_MAX_ENTRIES
+
+        overflow = cls.query.count() - max_entries
+        if overflow <= 0:
+            return 0
+
+        oldest = [row.address for row in db.session.query(cls.address).order_by(
+            cls.last_used.asc()).limit(overflow)]
+        removed = cls.query.filter(cls.address.in_(oldest)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+        cache_stats['geocode']['evictions'] += removed
+        return removed
+
+    def __repr__(self):
+        return f"<GeocodeCache {self.address}: lat: {self.lat}, lng: {self.lng}, last_used: {self.last_used}>"
@@ -0,0 +1,279 @@
+from collections import OrderedDict
+import json
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+
+
+# Every backend stores entries as (expires_at, stale_until, value) under a
+# namespace (one per TTLCache) and keeps each namespace to max_entries by
+# dropping its least recently used keys. Backends never raise on I/O
+# problems, a broken cache just means more upstream calls. Values that can't
+# be deserialized (e.g. written before CACHE_SERIALIZER changed) are misses.
+
+TOUCH_INTERVAL = 60
+# sqlite only rewrites last_used once a minute so a cache hit isn't also a
+# write holding the file's single write lock, LRU order is approximate
+
+
+class JSONSerializer:
+    """Default, safe to share across processes/machines"""
+
+    def dumps(self, value):
+        return json.dumps(value).encode('utf8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class PickleSerializer:
+    """Keeps tuples/datetimes intact, only use with a trusted backend"""
+
+    def dumps(self, value):
+        return pickle.dumps(value)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+SERIALIZERS = {'json': JSONSerializer, 'pickle': PickleSerializer}
+
+
+def key_string(key):
+    """Stable string for a cache key, ('a', 1) -> '["a", 1]'"""
+
+    return json.dumps(key)
+
+
+class MemoryBackend:
+    """In-process LRU, each worker has its own copy"""
+
+    def __init__(self):
+        self.namespaces = {}
+        self.lock = threading.Lock()
+
+    def get(self, namespace, key):
+        with self.lock:
+            entries = self.namespaces.get(namespace)
+            if not entries or key not in entries:
+                return None
+
+            entries.move_to_end(key)
+            return entries[key]
+
+    def set(self, namespace, key, entry, max_entries):
+        """Stores entry, returns how many old keys were evicted"""
+
+        with self.lock:
+            entries = self.namespaces.setdefault(namespace, OrderedDict())
+            entries[key] = entry
+            entries.move_to_end(key)
+
+            evicted = 0
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+                evicted += 1
+
+            return evicted
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self.namespaces.get(namespace, {}).pop(key, None)
+
+    def clear(self, namespace):
+        with self.lock:
+            self.namespaces.pop(namespace, None)
+
+    def count(self, namespace):
+        with self.lock:
+            return len(self.namespaces.get(namespace, {}))
+
+
+class SQLiteBackend:
+    """On-disk store shared by every worker on one machine"""
+
+    def __init__(self, path, serializer=None):
+        self.path = path
+        self.serializer = serializer or JSONSerializer()
+        self.local = threading.local()
+        # sqlite connections can't be shared between threads
+
+        self.connection().execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                stale_until REAL NOT NULL,
+                last_used REAL NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (namespace, key))""")
+        self.connection().execute("""
+            CREATE INDEX IF NOT EXISTS ix_cache_entries_lru
+            ON cache_entries (namespace, last_used)""")
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # readers don't block the writer across workers
+            self.local.conn = conn
+        return conn
+
+    def get(self, namespace, key):
+        try:
+            conn = self.connection()
+            row = conn.execute(
+                'SELECT expires_at, stale_until, last_used, value FROM cache_entries '
+                'WHERE namespace = ? AND key = ?', (namespace, key_string(key))).fetchone()
+            if row is None:
+                return None
+
+            now = time.time()
+            if row[2] + TOUCH_INTERVAL <= now:
+                conn.execute('UPDATE cache_entries SET last_used = ? '
+                             'WHERE namespace = ? AND key = ?', (now, namespace, key_string(key)))
+        except sqlite3.Error:
+            return None
+
+        try:
+            return (row[0], row[1], self.serializer.loads(row[3]))
+        except Exception:
+            return None
+            # unreadable value, the next set overwrites it
+
+    def set(self, namespace, key, entry, max_entries):
+        expires_at, stale_until, value = entry
+
+        try:
+            conn = self.connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entries '
+                '(namespace, key, expires_at, stale_until, last_used, value) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (namespace, key_string(key), expires_at, stale_until, time.time(),
+                 self.serializer.dumps(value)))
+
+            overflow = self.count(namespace) - max_entries
+            if overflow <= 0:
+                return 0
+
+            conn.execute(
+                'DELETE FROM cache_entries WHERE namespace = ? AND key IN ('
+                'SELECT key FROM cache_entries WHERE namespace = ? '
+                'ORDER BY last_used LIMIT ?)', (namespace, namespace, overflow))
+            return overflow
+        except sqlite3.Error:
+            return 0
+
+    def delete(self, namespace, key):
+        try:
+            self.connection().execute('DELETE FROM cache_entries WHERE namespace = ? AND key = ?',
+                                      (namespace, key_string(key)))
+        except sqlite3.Error:
+            pass
+
+    def clear(self, namespace):
+        try:
+            self.connection().execute('DELETE FROM cache_entries WHERE namespace = ?', (namespace,))
+        except sqlite3.Error:
+            pass
+
+    def count(self, namespace):
+        try:
+            return self.connection().execute(
+                'SELECT count(*) FROM cache_entries WHERE namespace = ?', (namespace,)).fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+
+class NetworkBackend:
+    """Client for a key-value server shared by every worker, see cache_server.py
+
+    Speaks one json object per line, values are serialized client side
+    and sent as latin-1 text so the server never has to understand them"""
+
+    def __init__(self, host, port, serializer=None, timeout=0.5):
+        self.host = host
+        self.port = port
+        self.serializer = serializer or JSONSerializer()
+        self.timeout = timeout
+        self.local = threading.local()
+        # one connection per thread, kept open between calls
+
+    def request(self, **message):
+        """Sends one command, returns the reply or None if the server is unreachable"""
+
+        for attempt in range(2):
+            # second try covers a kept-alive socket the server has closed
+            conn = getattr(self.local, 'conn', None)
+            try:
+                if conn is None:
+                    sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+                    conn = self.local.conn = (sock, sock.makefile('rwb'))
+
+                sock, stream = conn
+                stream.write(json.dumps(message).encode('utf8') + b'\n')
+                stream.flush()
+                line = stream.readline()
+                if not line:
+                    raise ConnectionError('cache server closed connection')
+
+                return json.loads(line)
+            except (OSError, ValueError):
+                self.local.conn = None
+                if conn is not None:
+                    conn[0].close()
+
+        return None
+
+    def get(self, namespace, key):
+        reply = self.request(op='get', ns=namespace, key=key_string(key))
+        if not reply or reply.get('entry') is None:
+            return None
+
+        expires_at, stale_until, data = reply['entry']
+        try:
+            return (expires_at, stale_until, self.serializer.loads(data.encode('latin-1')))
+        except Exception:
+            return None
+            # unreadable value, the next set overwrites it
+
+    def set(self, namespace, key, entry, max_entries):
+        expires_at, stale_until, value = entry
+        data = self.serializer.dumps(value).decode('latin-1')
+
+        reply = self.request(op='set', ns=namespace, key=key_string(key),
+                             entry=[expires_at, stale_until, data], max_entries=max_entries)
+        return reply.get('evicted', 0) if reply else 0
+
+    def delete(self, namespace, key):
+        self.request(op='delete', ns=namespace, key=key_string(key))
+
+    def clear(self, namespace):
+        self.request(op='clear', ns=namespace)
+
+    def count(self, namespace):
+        reply = self.request(op='count', ns=namespace)
+        return reply.get('count', 0) if reply else 0
+
+
+def make_backend(backend='memory', url=None, serializer='json'):
+    """Builds a backend from config
+
+    memory                        -> MemoryBackend
+    sqlite  url=/tmp/cache.db     -> SQLiteBackend
+    network url=localhost:7070    -> NetworkBackend"""
+
+    serializer = SERIALIZERS[serializer]()
+
+    if backend == 'sqlite':
+        return SQLiteBackend(url or 'cache.db', serializer)
+
+    if backend == 'network':
+        host, port = (url or 'localhost:7070').rsplit(':', 1)
+        return NetworkBackend(host, int(port), serializer)
+
+    return MemoryBackend()
@@ -0,0 +1,89 @@
+"""Small key-value server for CACHE_BACKEND=network.
+
+Every worker (and every app server) pointed at the same server shares one
+cache, so a search cached by one worker is a hit on the others and
+forget_user reaches all of them. Stand-in for memcached/redis in dev and
+tests, entries are kept in memory with the same LRU rules as the
+in-process backend.
+
+run like:
+
+   python cache_server.py                 # localhost:7070
+   python cache_server.py 0.0.0.0 7071
+"""
+
+from cache_backends import MemoryBackend
+import json
+import socketserver
+import sys
+import threading
+
+
+class CacheHandler(socketserver.StreamRequestHandler):
+    """One json command per line, one json reply per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.run(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'error': str(e)}
+
+            self.wfile.write(json.dumps(reply).encode('utf8') + b'\n')
+            self.wfile.flush()
+
+
+class CacheServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, CacheHandler)
+        self.backend = MemoryBackend()
+        # values arrive already serialized, the server only stores strings
+
+    def run(self, message):
+        op, namespace = message['op'], message['ns']
+
+        if op == 'get':
+            entry = self.backend.get(namespace, message['key'])
+            return {'entry': list(entry) if entry else None}
+
+        if op == 'set':
+            evicted = self.backend.set(namespace, message['key'], tuple(message['entry']),
+                                       message['max_entries'])
+            return {'evicted': evicted}
+
+        if op == 'delete':
+            self.backend.delete(namespace, message['key'])
+            return {}
+
+        if op == 'clear':
+            self.backend.clear(namespace)
+            return {}
+
+        if op == 'count':
+            return {'count': self.backend.count(namespace)}
+
+        raise ValueError(f'Unknown op {op}')
+
+
+def start(host='localhost', port=0):
+    """Starts a server on a background thread, port 0 picks a free one"""
+
+    server = CacheServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    host = sys.argv[1] if len(sys.argv) > 1 else 'localhost'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 7070
+
+    server = CacheServer((host, port))
+    print(f'cache server listening on {host}:{port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+"""Local stand-in for the Google Maps and OpenWeather APIs.
+
+Serves geocode, nearbysearch, directions and forecast responses shaped like
+the real ones so /search can run (and be load tested) offline. Forecasts
+are the weather.txt sample moved to the current time and location, the
+Google responses are generated from a hash of the request so the same
+query always gets the same answer.
+
+Latency, server errors and rate limiting can be injected from the command
+line or changed while it runs by POSTing json to /_fake/config.
+
+run like:
+
+   python fake_upstream.py                            # localhost:5050
+   python fake_upstream.py --latency 80 --jitter 40 --error-rate 0.02
+   python fake_upstream.py --rate-limit 0.05 --max-per-second 50
+
+then start the app pointed at it:
+
+   GOOGLE_API_URL=http://localhost:5050/maps/api \\
+   OPENWEATHER_API_URL=http://localhost:5050/data/2.5 flask run
+"""
+
+from flask import Flask, request, jsonify
+import argparse
+import ast
+import copy
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+
+
+SLOT = 60 * 60 * 3
+# OpenWeather forecast step
+
+config = {
+    'latency': 0,
+    # ms added to every response
+    'jitter': 0,
+    # ms, latency varies by up to this much either way
+    'error_rate': 0.0,
+    # fraction of requests answered with a 500
+    'rate_limit': 0.0,
+    # fraction of requests answered with 429 / OVER_QUERY_LIMIT
+    'max_per_second': 0,
+    # per endpoint, requests past this in one second are rate limited, 0 is no limit
+}
+
+stats = {}
+_lock = threading.Lock()
+_windows = {}
+# endpoint -> (second, requests in that second)
+
+app = Flask(__name__)
+
+
+def load_sample_forecast():
+    """Parses the pprinted response in weather.txt"""
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weather.txt')
+    with open(path) as f:
+        text = f.read()
+
+    return ast.literal_eval(text[text.index('{'):])
+    # first line is a description, the rest is a python literal
+
+
+SAMPLE_FORECAST = load_sample_forecast()
+
+TRAIL_WORDS = ['Pine', 'Ridge', 'Cedar', 'Falls', 'Summit', 'Hollow', 'Brook', 'Maple',
+               'Granite', 'Heron', 'Birch', 'Meadow', 'Quarry', 'Fox', 'Laurel', 'Echo']
+TRAIL_KINDS = ['Trail', 'Loop', 'Path', 'Reservation', 'State Park', 'Conservation Area']
+MANEUVERS = [None, 'turn-left', 'turn-right', 'merge', 'ramp-right', 'keep-left']
+
+
+def rng_for(*parts):
+    """Random generator seeded from the request so answers are repeatable"""
+
+    seed = hashlib.sha1('|'.join(str(part) for part in parts).encode('utf8')).hexdigest()
+    return random.Random(int(seed[:16], 16))
+
+
+def record(endpoint, outcome):
+    with _lock:
+        counts = stats.setdefault(endpoint, {'requests': 0, 'errors': 0, 'rate_limited': 0})
+        counts['requests'] += 1
+        if outcome:
+            counts[outcome] += 1
+
+
+def over_limit(endpoint):
+    """True if this request should get a rate limit response"""
+
+    if config['rate_limit'] and random.random() < config['rate_limit']:
+        return True
+
+    if not config['max_per_second']:
+        return False
+
+    with _lock:
+        second = int(time.time())
+        window_second, count = _windows.get(endpoint, (second, 0))
+        if window_second != second:
+            count = 0
+        _windows[endpoint] = (second, count + 1)
+
+    return count >= config['max_per_second']
+
+
+def inject(endpoint, rate_limited):
+    """Sleeps for the configured latency, returns an error response or None"""
+
+    delay = config['latency'] + random.uniform(-config['jitter'], config['jitter'])
+    if delay > 0:
+        time.sleep(delay / 1000)
+
+    if config['error_rate'] and random.random() < config['error_rate']:
+        record(endpoint, 'errors')
+        return jsonify(error='injected server error'), 500
+        # upstream.py retries these
+
+    if over_limit(endpoint):
+        record(endpoint, 'rate_limited')
+        return rate_limited()
+
+    record(endpoint, None)
+    return None
+
+
+def google_over_limit():
+    # Google answers 200 and puts the problem in status
+    return jsonify(status='OVER_QUERY_LIMIT', results=[],
+                   error_message='You have exceeded your rate-limit for this API.')
+
+
+def openweather_over_limit():
+    return jsonify(cod=429, message='Your account is temporary blocked due to '
+                                    'exceeding of requests limitation'), 429
+
+
+def parse_location(location):
+    lat, lng = location.split(',')
+    return float(lat), float(lng)
+
+
+def geocode_response(address):
+    normalized = ' '.join(address.lower().split())
+    if not normalized:
+        return {'status': 'ZERO_RESULTS', 'results': []}
+
+    rng = rng_for('geocode', normalized)
+    lat = round(rng.uniform(30, 47), 7)
+    lng = round(rng.uniform(-122, -72), 7)
+    # somewhere in the continental US
+
+    return {
+        'status': 'OK',
+        'results': [{
+            'formatted_address': address.strip(),
+            'geometry': {'location': {'lat': lat, 'lng': lng}, 'location_type': 'APPROXIMATE'},
+            'place_id': f'fake_geo_{rng.getrandbits(64):016x}',
+            'types': ['street_address'],
+        }],
+    }
+
+
+def nearby_response(location, radius, keyword):
+    lat, lng = parse_location(location)
+    rng = rng_for('nearby', location, radius, keyword)
+
+    count = min(20, 3 + radius // 2000 + rng.randint(0, 4))
+    # more hikes in bigger circles, nearbysearch never returns more than 20
+    results = []
+
+    for i in range(count):
+        distance = rng.uniform(0, radius) / 111320
+        # meters -> degrees, close enough for a fake
+        angle = rng.uniform(0, 2 * math.pi)
+        name = f'{rng.choice(TRAIL_WORDS)} {rng.choice(TRAIL_WORDS)} {rng.choice(TRAIL_KINDS)}'
+
+        results.append({
+            'name': name,
+            'place_id': f'fake_{rng.getrandbits(96):024x}',
+            'vicinity': f'{rng.randint(1, 999)} {rng.choice(TRAIL_WORDS)} Rd, Faketown',
+            'geometry': {'location': {'lat': round(lat + distance * math.sin(angle), 7),
+                                      'lng': round(lng + distance * math.cos(angle), 7)}},
+            'rating': round(rng.uniform(3, 5), 1),
+            'types': ['park', 'point_of_interest', 'establishment'],
+        })
+
+    return {'status': 'OK' if results else 'ZERO_RESULTS', 'results': results,
+            'html_attributions': []}
+
+
+def directions_response(origin, destination):
+    if not destination.startswith('place_id:'):
+        return {'status': 'NOT_FOUND', 'routes': []}
+
+    rng = rng_for('directions', ' '.join(origin.lower().split()), destination)
+    steps = []
+
+    for i in range(rng.randint(3, 9)):
+        miles = round(rng.uniform(0.1, 8), 1)
+        steps.append({
+            'html_instructions': f'Head toward <b>{rng.choice(TRAIL_WORDS)} St</b>',
+            'distance': {'text': f'{miles} mi', 'value': int(miles * 1609)},
+            'duration': {'text': f'{max(1, int(miles * 2))} mins', 'value': int(miles * 120)},
+            'maneuver': rng.choice(MANEUVERS),
+            'polyline': {'points': 'fake'},
+        })
+
+    meters = sum(step['distance']['value'] for step in steps)
+    seconds = sum(step['duration']['value'] for step in steps)
+    leg = {
+        'distance': {'text': f'{meters / 1609:.1f} mi', 'value': meters},
+        'duration': {'text': f'{seconds // 60} mins', 'value': seconds},
+        'start_address': origin,
+        'end_address': f'{destination}, Faketown',
+        'steps': steps,
+    }
+
+    return {'status': 'OK', 'routes': [{'legs': [leg], 'summary': 'Fake Rd',
+                                        'overview_polyline': {'points': 'fake'}}]}
+
+
+def forecast_response(lat, lon, now=None):
+    """weather.txt sample starting at the next slot, temps nudged per location"""
+
+    if now is None:
+        now = time.time()
+
+    forecast = copy.deepcopy(SAMPLE_FORECAST)
+    rng = rng_for('forecast', round(lat, 1), round(lon, 1))
+    offset = rng.uniform(-8, 8)
+    start = (int(now) // SLOT + 1) * SLOT
+
+    for i, slot in enumerate(forecast['list']):
+        slot['dt'] = start + i * SLOT
+        slot['dt_txt'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(slot['dt']))
+        for field in ('temp', 'feels_like', 'temp_min', 'temp_max'):
+            slot['main'][field] = round(slot['main'][field] + offset, 2)
+
+    forecast['city']['coord'] = {'lat': lat, 'lon': lon}
+    return forecast
+
+
+@app.route('/maps/api/geocode/json')
+def geocode():
+    error = inject('geocode', google_over_limit)
+    if error is not None:
+        return error
+
+    return jsonify(geocode_response(request.args.get('address', '')))
+
+
+@app.route('/maps/api/place/nearbysearch/json')
+def nearbysearch():
+    error = inject('places', google_over_limit)
+    if error is not None:
+        return error
+
+    try:
+        location = request.args['location']
+        parse_location(location)
+        radius = int(float(request.args.get('radius', 5000)))
+    except (KeyError, ValueError):
+        return jsonify(status='INVALID_REQUEST', results=[])
+
+    return jsonify(nearby_response(location, radius, request.args.get('keyword', '')))
+
+
+@app.route('/maps/api/directions/json')
+def directions():
+    error = inject('directions', google_over_limit)
+    if error is not None:
+        return error
+
+    return jsonify(directions_response(request.args.get('origin', ''),
+                                       request.args.get('destination', '')))
+
+
+@app.route('/data/2.5/forecast')
+def forecast():
+    error = inject('forecast', openweather_over_limit)
+    if error is not None:
+        return error
+
+    try:
+        lat, lon = float(request.args['lat']), float(request.args['lon'])
+    except (KeyError, ValueError):
+        return jsonify(cod='400', message='wrong latitude'), 400
+
+    return jsonify(forecast_response(lat, lon))
+
+
+@app.route('/_fake/config', methods=['GET', 'POST'])
+def fake_config():
+    """Shows or changes the injected latency/errors, POST only what should change"""
+
+    if request.method == 'POST':
+        changes = request.json or {}
+        unknown = set(changes) - set(config)
+        if unknown:
+            return jsonify(error=f'unknown settings {sorted(unknown)}'), 400
+        config.update({name: float(value) for name, value in changes.items()})
+
+    return jsonify(config)
+
+
+@app.route('/_fake/stats', methods=['GET', 'DELETE'])
+def fake_stats():
+    """Requests per endpoint, DELETE resets the counts"""
+
+    if request.method == 'DELETE':
+        with _lock:
+            stats.clear()
+
+    return jsonify(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Google Maps/OpenWeather server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--latency', type=float, default=0, help='ms added to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='ms of +/- latency variation')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction answered with 500')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='fraction answered with 429/OVER_QUERY_LIMIT')
+    parser.add_argument('--max-per-second', type=float, default=0,
+                        help='rate limit each endpoint past this many requests a second')
+    args = parser.parse_args()
+
+    config.update(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                  rate_limit=args.rate_limit, max_per_second=args.max_per_second)
+
+    app.run(host=args.host, port=args.port, threaded=True)
+    # threaded so injected latency overlaps like it does on the real APIs
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,10 @@ from wtforms import StringField, PasswordField, SelectField
 from wtforms.validators import InputRequired, Email, Length
 
 
+RADIUS_CHOICES = [(5000, 3), (8000, 5), (12500, 8),
+                  (16000, 10), (24000, 15), (32000, 20)]
+# (meters sent to Google, miles shown to user)
+
 class RegisterForm(FlaskForm):
     """Registration Form"""
     username = StringField('Username', validators=[InputRequired()])
@@ -0,0 +1,236 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+import fcntl
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+
+HASH_SLOTS = int(os.environ.get('HASH_SLOTS', max(1, (os.cpu_count() or 2) // 2)))
+# bcrypt runs at once across every worker on this machine, the other cores keep
+# serving searches during a login burst, 0 is no limit
+HASH_SLOT_WAIT = float(os.environ.get('HASH_SLOT_WAIT', 1))
+# seconds to wait for a free slot before turning the request away, a few
+# cost 12 hashes so two logins at once don't turn one away
+HASH_SLOT_DIR = os.environ.get('HASH_SLOT_DIR', tempfile.gettempdir())
+# slots are flock()ed files here, the kernel frees a dead worker's slot
+
+HASH_EXECUTOR = os.environ.get('HASH_EXECUTOR', 'inline')
+# 'inline' hashes on the request thread, bcrypt releases the GIL so threaded
+# workers keep serving while it runs. 'process'/'thread' use a per-worker pool
+# so HASH_TIMEOUT can abandon a slow hash, at the cost of a fork and IPC
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 1))
+HASH_QUEUE_LIMIT = int(os.environ.get('HASH_QUEUE_LIMIT', 8))
+# hashes running or waiting per worker, past this requests are turned away right away
+# only threaded workers (gunicorn --threads/gthread) can queue more than one hash,
+# HASH_SLOTS is what bounds sync workers
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', 10))
+# pool executors only, an inline hash can't be abandoned
+
+hash_stats = {
+    'submitted': 0,
+    'completed': 0,
+    'rejected': 0,
+    'no_slot': 0,
+    'timeouts': 0,
+    'pool_restarts': 0,
+    'queue_depth': 0,
+    'max_queue_depth': 0,
+    'total_wait_ms': 0.0,
+    'max_wait_ms': 0.0,
+}
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+class HashQueueFull(Exception):
+    """Raised when too many password hashes are already queued"""
+
+
+def _check(hashed, password):
+    # runs in the pool, returns when it started so wait time can be measured
+    started = time.time()
+    return bcrypt.checkpw(password.encode('utf8'), hashed.encode('utf8')), started
+
+
+def _generate(password, rounds):
+    started = time.time()
+    return bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt(rounds)).decode('utf8'), started
+
+
+def get_executor(broken=None):
+    """Returns this worker's hashing pool
+
+    Pass the pool that raised BrokenProcessPool as broken to replace it,
+    a process pool whose child died never recovers on its own"""
+
+    global _executor, _executor_pid
+
+    with _lock:
+        if broken is not None and broken is _executor:
+            _executor.shutdown(wait=False)
+            _executor = None
+            hash_stats['pool_restarts'] += 1
+
+        if _executor is None or _executor_pid != os.getpid():
+            if HASH_EXECUTOR == 'thread':
+                _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='hashing')
+            else:
+                _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+                # a forked child would inherit, and keep, the slot its request holds
+            _executor_pid = os.getpid()
+
+        return _executor
+
+
+def acquire_slot():
+    """Takes one of the machine's HASH_SLOTS, waiting up to HASH_SLOT_WAIT
+
+    Returns the locked file, closing it frees the slot. None if every slot
+    stayed busy"""
+
+    deadline = time.time() + HASH_SLOT_WAIT
+
+    while True:
+        for i in range(HASH_SLOTS):
+            slot = open(os.path.join(HASH_SLOT_DIR, f'hike_finder_hash_slot_{i}.lock'), 'a')
+            # a new file each time, threads of one worker sharing an open file share its lock
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except OSError:
+                slot.close()
+
+        if time.time() >= deadline:
+            return None
+        time.sleep(0.01)
+
+
+def record(started, submitted):
+    wait_ms = max(started - submitted, 0) * 1000
+    with _lock:
+        hash_stats['completed'] += 1
+        hash_stats['total_wait_ms'] += wait_ms
+        hash_stats['max_wait_ms'] = max(hash_stats['max_wait_ms'], wait_ms)
+
+
+def submit(func, *args):
+    """Submits to the pool, rebuilding it once if a child process died
+
+    Returns (pool, future)"""
+
+    executor = get_executor()
+    try:
+        return executor, executor.submit(func, *args)
+    except BrokenProcessPool:
+        executor = get_executor(broken=executor)
+        return executor, executor.submit(func, *args)
+
+
+def run(func, *args):
+    """Runs a hash function once a machine-wide slot is free
+
+    Raises HashQueueFull if no slot frees up in time, this worker's queue
+    is full or a pool hash doesn't finish within HASH_TIMEOUT, all are
+    handled by the app as 'try again'"""
+
+    slot = acquire_slot() if HASH_SLOTS > 0 else None
+    if HASH_SLOTS > 0 and slot is None:
+        with _lock:
+            hash_stats['rejected'] += 1
+            hash_stats['no_slot'] += 1
+        raise HashQueueFull()
+
+    with _lock:
+        if hash_stats['queue_depth'] >= HASH_QUEUE_LIMIT:
+            hash_stats['rejected'] += 1
+            full = True
+        else:
+            full = False
+            hash_stats['submitted'] += 1
+            hash_stats['queue_depth'] += 1
+            hash_stats['max_queue_depth'] = max(hash_stats['max_queue_depth'],
+                                                hash_stats['queue_depth'])
+
+    if full:
+        if slot is not None:
+            slot.close()
+        raise HashQueueFull()
+
+    def release():
+        with _lock:
+            hash_stats['queue_depth'] -= 1
+        if slot is not None:
+            slot.close()
+
+    submitted = time.time()
+
+    if HASH_EXECUTOR == 'inline':
+        try:
+            result, started = func(*args)
+        finally:
+            release()
+        record(started, submitted)
+        return result
+
+    try:
+        executor, future = submit(func, *args)
+    except Exception:
+        release()
+        raise
+
+    call = {'abandoned': False}
+
+    def finished(future):
+        # a timed out hash keeps its queue spot and slot until bcrypt stops
+        with _lock:
+            abandoned = call['abandoned']
+        if abandoned:
+            release()
+
+    future.add_done_callback(finished)
+
+    try:
+        result, started = future.result(timeout=HASH_TIMEOUT)
+    except TimeoutError:
+        with _lock:
+            hash_stats['timeouts'] += 1
+            call['abandoned'] = not future.done()
+        if not call['abandoned']:
+            release()
+        raise HashQueueFull()
+    except BrokenProcessPool:
+        release()
+        get_executor(broken=executor)
+        raise HashQueueFull()
+        # child died mid-hash, next request gets a fresh pool
+    except Exception:
+        release()
+        raise
+
+    release()
+    record(started, submitted)
+
+    return result
+
+
+def check_password_hash(hashed, password):
+    """Off-thread version of bcrypt.check_password_hash"""
+
+    return run(_check, hashed, password)
+
+
+def generate_password_hash(password, rounds):
+    """Off-thread version of bcrypt.generate_password_hash, returns utf8 str"""
+
+    if not password:
+        raise ValueError('Password must be non-empty.')
+        # same error Flask-Bcrypt raised
+
+    return run(_generate, password, rounds)
@@ -0,0 +1,76 @@
+from cache import TTLCache
+from user import User
+import os
+
+
+IDENTITY_FIELDS = ('id', 'username', 'first_name', 'last_name', 'email', 'is_admin')
+# enough to render nav/profile info, password hash is never cached
+
+identity_cache = TTLCache('identity', ttl=int(os.environ.get('IDENTITY_CACHE_TTL', 300)),
+                          max_entries=int(os.environ.get('IDENTITY_CACHE_SIZE', 1000)))
+# with the default memory backend other workers can be stale until the ttl runs out
+
+
+def forget_user(user_id):
+    """Drops a user from the identity cache after it changes"""
+
+    identity_cache.delete(user_id)
+
+
+class CurrentUser:
+    """Stands in for the logged in User on g and only queries when needed
+
+    g.user.id never touches the db, the other identity fields come from the
+    cache and anything else (check_password etc.) loads the real User"""
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self._user = None
+        self._missing = False
+
+    def load(self):
+        """Returns the real User, querying for it the first time
+
+        None if the account is gone, which also drops the cached identity
+        since another worker may have deleted it after it was cached"""
+
+        if self._user is None and not self._missing:
+            self._user = User.query.get(self.id)
+
+            if self._user is None:
+                self._missing = True
+                forget_user(self.id)
+
+        return self._user
+
+    def identity(self):
+        """Returns cached identity fields or None if the user no longer exists"""
+
+        if self._missing:
+            return None
+
+        identity = identity_cache.get(self.id)
+        if identity is not None:
+            return identity
+
+        user = self.load()
+        if user is None:
+            return None
+
+        identity = {field: getattr(user, field) for field in IDENTITY_FIELDS}
+        identity_cache.set(self.id, identity)
+
+        return identity
+
+    def __bool__(self):
+        # a deleted account behaves like being logged out
+        return self.identity() is not None
+
+    def __getattr__(self, name):
+        # only called for attributes not set in __init__
+        if name in IDENTITY_FIELDS:
+            identity = self.identity()
+            if identity is not None:
+                return identity[name]
+
+        return getattr(self.load(), name)
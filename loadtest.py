@@ -0,0 +1,320 @@
+"""Load test for the main user flow.
+
+Each simulated user registers, logs out and back in, then runs searches.
+For every search it fetches the forecast, clicks directions for a few
+hikes and loads the past searches page. Directions follow static/app.js:
+each click is a GET /search/details, unless the user pressed "Directions
+to every hike" (--batch-rate of searches), which is one
+/search/details/batch POST that later clicks are served from. Reports
+requests/sec and p50/p95/p99 latency per route and saves them as json so
+two runs (e.g. before/after a change) can be compared.
+
+Run it against the app pointed at fake_upstream.py so Google/OpenWeather
+aren't hit and their latency is controlled:
+
+   python fake_upstream.py --latency 80 --jitter 40 &
+   GOOGLE_API_URL=http://localhost:5050/maps/api \\
+   OPENWEATHER_API_URL=http://localhost:5050/data/2.5 \\
+   LOGIN_IP_BURST=100000 LOGIN_IP_PER_MINUTE=100000 HASH_SLOT_WAIT=10 \\
+   gunicorn -w 4 app:app -b localhost:5000 &
+   # every simulated user logs in from the same ip, lift the login throttle,
+   # and they all register at once, let them queue for a bcrypt slot
+
+   python loadtest.py run --users 20 --searches 5 --out before.json
+   ... change something, restart the app ...
+   python loadtest.py run --users 20 --searches 5 --out after.json
+   python loadtest.py compare before.json after.json
+
+compare exits with 1 if any route got slower than --threshold percent.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+import argparse
+import json
+import math
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+
+CSRF_RE = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+HIKE_RE = re.compile(r'<div id="([^"]+)" data-lat="([^"]+)" data-lng="([^"]+)"')
+RADII = [5000, 8000, 12500, 16000, 24000, 32000]
+STATS = ('p50', 'p95', 'p99')
+
+
+class Recorder:
+    """Collects (route, seconds, ok) for every request, shared by all users"""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, route, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(route, []).append((seconds, ok))
+
+
+class User:
+    """One simulated browser session"""
+
+    def __init__(self, base_url, recorder, addresses, directions_per_search, batch_rate=0):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.addresses = addresses
+        self.directions_per_search = directions_per_search
+        self.batch_rate = batch_rate
+        self.session = requests.Session()
+        self.username = f'load_{uuid.uuid4().hex[:12]}'
+        self.password = 'loadtest-password'
+
+    def request(self, method, path, route=None, ok_statuses=(200,), redirect_to=None, **kwargs):
+        """Times one request, route is the name results are grouped under
+
+        redirect_to: a redirect only counts as ok if it goes here, failed
+        forms redirect too (e.g. register back to /register)"""
+
+        start = time.perf_counter()
+        try:
+            resp = self.session.request(method, self.base_url + path, timeout=30,
+                                        allow_redirects=False, **kwargs)
+            ok = resp.status_code in ok_statuses
+            if ok and redirect_to is not None:
+                ok = urlsplit(resp.headers.get('Location', '')).path == redirect_to
+        except requests.RequestException:
+            resp, ok = None, False
+
+        self.recorder.add(route or f'{method} {path}', time.perf_counter() - start, ok)
+        return resp
+
+    def csrf(self, path):
+        resp = self.request('GET', path)
+        match = CSRF_RE.search(resp.text) if resp is not None else None
+        return match.group(1) if match else ''
+
+    def register(self):
+        self.request('POST', '/register', ok_statuses=(302,), redirect_to='/search', data={
+            'csrf_token': self.csrf('/register'),
+            'username': self.username,
+            'password': self.password,
+            'email': f'{self.username}@example.com',
+            'first_name': 'Load',
+            'last_name': 'Test',
+        })
+        self.request('GET', '/logout', ok_statuses=(302,))
+
+    def login(self):
+        self.request('POST', '/login', ok_statuses=(302,), redirect_to='/search', data={
+            'csrf_token': self.csrf('/login'),
+            'username': self.username,
+            'password': self.password,
+        })
+
+    def search(self):
+        address = random.choice(self.addresses)
+        resp = self.request('POST', '/search', data={
+            'csrf_token': self.csrf('/search'),
+            'address': address,
+            'radius': random.choice(RADII),
+        })
+        hikes = HIKE_RE.findall(resp.text) if resp is not None else []
+
+        if hikes:
+            place_id, lat, lng = hikes[0]
+            self.request('GET', '/search/forecast', params={'lat': lat, 'lng': lng})
+
+        batch = set()
+        if hikes and random.random() < self.batch_rate:
+            batch = self.batch(address, [hike[0] for hike in hikes])
+            # pressed "Directions to every hike"
+
+        for place_id, lat, lng in hikes[:self.directions_per_search]:
+            if place_id in batch:
+                continue
+                # already fetched by the batch, the browser makes no request
+
+            self.request('GET', '/search/details', params={
+                'origin_address': address, 'destination_id': place_id})
+
+        self.request('GET', '/search/past')
+
+    def batch(self, address, place_ids):
+        """Fetches directions to every hike at once, returns the place_ids it got"""
+
+        resp = self.request('POST', '/search/details/batch', json={
+            'origin_address': address, 'destination_ids': place_ids})
+
+        try:
+            return set(resp.json()['results'])
+        except (AttributeError, ValueError, KeyError):
+            return set()
+            # failed batch, later clicks fall back to /search/details
+
+    def run(self, searches):
+        self.register()
+        self.login()
+        for i in range(searches):
+            self.search()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+
+    if not values:
+        return None
+
+    rank = math.ceil(pct / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def summarize(samples, elapsed):
+    """Turns raw samples into counts, throughput and latency percentiles in ms"""
+
+    latencies = sorted(seconds * 1000 for seconds, ok in samples)
+    errors = sum(1 for seconds, ok in samples if not ok)
+
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'error_rate': round(errors / len(samples), 4) if samples else 0,
+        'rps': round(len(samples) / elapsed, 2) if elapsed else 0,
+        'mean': round(sum(latencies) / len(latencies), 2) if latencies else None,
+        'p50': round(percentile(latencies, 50), 2) if latencies else None,
+        'p95': round(percentile(latencies, 95), 2) if latencies else None,
+        'p99': round(percentile(latencies, 99), 2) if latencies else None,
+        'max': round(latencies[-1], 2) if latencies else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    addresses = [f'{100 + i} Main St, Springfield' for i in range(args.addresses)]
+    # fewer addresses means more cache hits
+    recorder = Recorder()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        users = [User(args.base_url, recorder, addresses, args.directions, args.batch_rate)
+                 for i in range(args.users)]
+        for future in [executor.submit(user.run, args.searches) for user in users]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    all_samples = [sample for samples in recorder.samples.values() for sample in samples]
+
+    return {
+        'label': args.label or git_commit(),
+        'started_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'config': {'base_url': args.base_url, 'users': args.users, 'searches': args.searches,
+                   'addresses': args.addresses, 'directions': args.directions,
+                   'batch_rate': args.batch_rate},
+        'elapsed': round(elapsed, 2),
+        'total': summarize(all_samples, elapsed),
+        'routes': {route: summarize(samples, elapsed)
+                   for route, samples in sorted(recorder.samples.items())},
+    }
+
+
+def print_report(results):
+    print(f'{results["label"]}: {results["config"]["users"]} users, {results["elapsed"]}s')
+    print(f'{"route":<30} {"reqs":>6} {"errors":>6} {"req/s":>8} '
+          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+
+    for route, stats in list(results['routes'].items()) + [('total', results['total'])]:
+        print(f'{route:<30} {stats["requests"]:>6} {stats["errors"]:>6} {stats["rps"]:>8} '
+              f'{stats["p50"]:>8} {stats["p95"]:>8} {stats["p99"]:>8}')
+
+
+def compare(old, new, threshold):
+    """Returns rows of (route, stat, old, new, percent change, regressed)
+
+    A route regressed if a latency percentile went up, or throughput
+    went down, by more than threshold percent"""
+
+    rows = []
+
+    for route in sorted(set(old['routes']) & set(new['routes'])) + ['total']:
+        old_stats = old['total'] if route == 'total' else old['routes'][route]
+        new_stats = new['total'] if route == 'total' else new['routes'][route]
+
+        for stat in STATS + ('rps',):
+            before, after = old_stats[stat], new_stats[stat]
+            if not before or after is None:
+                continue
+
+            change = (after - before) / before * 100
+            worse = -change if stat == 'rps' else change
+            rows.append((route, stat, before, after, round(change, 1), worse > threshold))
+
+    return rows
+
+
+def print_comparison(old, new, rows):
+    print(f'{old["label"]} -> {new["label"]}')
+    print(f'{"route":<30} {"stat":>5} {"old":>9} {"new":>9} {"change":>8}')
+
+    for route, stat, before, after, change, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        print(f'{route:<30} {stat:>5} {before:>9} {after:>9} {change:>+7}%{flag}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the search flow')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run a load test and save the results')
+    run_parser.add_argument('--base-url', default='http://localhost:5000')
+    run_parser.add_argument('--users', type=int, default=10, help='concurrent users')
+    run_parser.add_argument('--searches', type=int, default=5, help='searches per user')
+    run_parser.add_argument('--addresses', type=int, default=25,
+                            help='distinct addresses searched across all users')
+    run_parser.add_argument('--directions', type=int, default=3,
+                            help='hikes per search to click directions for')
+    run_parser.add_argument('--batch-rate', type=float, default=0.1,
+                            help='fraction of searches that load directions to every hike')
+    run_parser.add_argument('--label', help='name for this run, defaults to the git commit')
+    run_parser.add_argument('--out', help='json file to save results to')
+
+    compare_parser = commands.add_parser('compare', help='compare two saved runs')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10,
+                                help='percent change that counts as a regression')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run(args)
+        print_report(results)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    rows = compare(old, new, args.threshold)
+    print_comparison(old, new, rows)
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
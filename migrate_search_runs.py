@@ -0,0 +1,88 @@
+"""Moves rows from the old flat map_searches table into search_runs/search_results.
+
+run like:
+
+   python migrate_search_runs.py           # copy rows, keep map_searches
+   python migrate_search_runs.py --drop    # copy rows then drop map_searches
+   python migrate_search_runs.py --force   # copy even if search_runs has rows
+
+New tables are created if missing. Every row is copied in one transaction,
+and the copy is skipped when search_runs already has rows so running it
+twice doesn't duplicate history. Run it before the app starts saving new
+searches, or pass --force.
+"""
+
+import sys
+
+from sqlalchemy import MetaData, Table, inspect
+from user import db
+from search import Search, SearchResult
+from app import app
+
+BATCH_SIZE = 1000
+
+
+def group_runs(rows):
+    """Groups flat rows (ordered by user_id, id) into runs
+
+    A new run starts when user/address/radius/timestamp changes or when a
+    place_id repeats, since one search never returns the same place twice"""
+
+    runs = []
+    current = None
+
+    for row in rows:
+        key = (row.user_id, row.address, row.radius, row.timestamp)
+
+        if current is None or current['key'] != key or row.place_id in current['place_ids']:
+            current = {'key': key, 'place_ids': set(), 'results': []}
+            runs.append(current)
+
+        current['place_ids'].add(row.place_id)
+        current['results'].append({'place_id': row.place_id, 'name': row.name})
+
+    return runs
+
+
+def migrate(drop=False, force=False):
+    if not inspect(db.engine).has_table('map_searches'):
+        print('map_searches not found, nothing to migrate')
+        return
+
+    db.create_all()
+    # creates search_runs/search_results, leaves existing tables alone
+
+    if not force and db.session.query(Search.id).first() is not None:
+        print('search_runs already has rows, skipping (already migrated? use --force)')
+        return
+
+    old_table = Table('map_searches', MetaData(), autoload_with=db.engine)
+    rows = db.session.execute(
+        old_table.select().order_by(old_table.c.user_id, old_table.c.id)).fetchall()
+    runs = group_runs(rows)
+
+    for start in range(0, len(runs), BATCH_SIZE):
+        batch = runs[start:start + BATCH_SIZE]
+
+        searches = []
+        for run in batch:
+            user_id, address, radius, timestamp = run['key']
+            search = Search(user_id=user_id, address=address, radius=radius, timestamp=timestamp)
+            search.results = [SearchResult(**result) for result in run['results']]
+            searches.append(search)
+
+        db.session.add_all(searches)
+        db.session.flush()
+        # flushed in batches but committed once, a failed run leaves nothing behind
+
+    db.session.commit()
+
+    print(f'migrated {len(rows)} map_searches rows into {len(runs)} search runs')
+
+    if drop:
+        old_table.drop(db.engine)
+        print('dropped map_searches')
+
+
+if __name__ == '__main__':
+    migrate(drop='--drop' in sys.argv, force='--force' in sys.argv)
@@ -0,0 +1,74 @@
+from flask import request
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+    # brotli is optional, gzip is always available
+
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+# bytes, smaller bodies don't shrink enough to be worth the cpu
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+COMPRESS_TYPES = ('text/html', 'application/json', 'text/css', 'application/javascript')
+
+
+def choose_encoding(accept_encoding):
+    """Picks br if the client and server both support it, then gzip"""
+
+    if brotli is not None and 'br' in accept_encoding:
+        return 'br'
+    if 'gzip' in accept_encoding:
+        return 'gzip'
+
+    return None
+
+
+def compress_response(response):
+    """Compresses large text/json bodies, used as an after_request hook"""
+
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_TYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    if encoding == 'br':
+        body = brotli.compress(body)
+    else:
+        body = gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+
+    return response
+
+
+def conditional(response, last_modified=None):
+    """Adds ETag (content hash) and Last-Modified, turns matches into a 304"""
+
+    response.add_etag()
+    etag, weak = response.get_etag()
+    response.set_etag(etag, weak=True)
+    # weak since the same etag is sent for gzip, br and plain bodies
+
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    # pages are per user, browser must revalidate but can reuse its copy
+
+    return response.make_conditional(request)
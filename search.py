@@ -1,79 +1,262 @@
 from operator import add
-import requests
-from secret import weather_key, google_key
+import upstream
 from user import db
+from cache import GeocodeCache, TTLCache, normalize_address
+from forms import RADIUS_CHOICES
+from collections import Counter
+from concurrent.futures import wait
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
 from datetime import datetime
+import os
+import time
 import pprint
 # pprint needed for parsing/debugging json responses
 
+try:
+    from secret import weather_key, google_key
+except ImportError:
+    weather_key = google_key = None
+    # secret.py isn't in the repo, keys can come from the environment instead
 
-FORECAST_BASE_URL = "https://api.openweathermap.org/data/2.5/forecast"
-GOOGLE_BASE_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/output"
-GOOGLE_GEOCODE = 'https://maps.googleapis.com/maps/api/geocode/json?'
+weather_key = os.environ.get('WEATHER_KEY', weather_key)
+google_key = os.environ.get('GOOGLE_KEY', google_key)
+
+GOOGLE_API_URL = os.environ.get('GOOGLE_API_URL', 'https://maps.googleapis.com/maps/api')
+OPENWEATHER_API_URL = os.environ.get('OPENWEATHER_API_URL', 'https://api.openweathermap.org/data/2.5')
+# point both at fake_upstream.py to run without the real APIs
+FORECAST_BASE_URL = f"{OPENWEATHER_API_URL}/forecast"
+GOOGLE_GEOCODE = f"{GOOGLE_API_URL}/geocode/json"
+GOOGLE_NEARBY = f"{GOOGLE_API_URL}/place/nearbysearch/json"
+GOOGLE_DIRECTIONS = f"{GOOGLE_API_URL}/directions/json"
+
+HIKE_CACHE_GRID = float(os.environ.get('HIKE_CACHE_GRID', 0.01))
+# degrees, 0.01 is roughly 1km so neighbouring addresses share results
+CACHE_JITTER = float(os.environ.get('CACHE_JITTER', 0.1))
+# ttls are cut by up to 10% so hot keys cached together don't expire together
+hike_cache = TTLCache('hikes', ttl=int(os.environ.get('HIKE_CACHE_TTL', 60 * 60 * 6)),
+                      max_entries=int(os.environ.get('HIKE_CACHE_SIZE', 2000)),
+                      grace=int(os.environ.get('HIKE_CACHE_GRACE', 60 * 60)), jitter=CACHE_JITTER)
+FORECAST_CACHE_GRID = float(os.environ.get('FORECAST_CACHE_GRID', 0.1))
+# degrees, weather is the same for every hike in a ~10km cell
+FORECAST_SLOT = 60 * 60 * 3
+# OpenWeather forecasts only change on 3 hour dt boundaries, see weather.txt
+forecast_cache = TTLCache('forecast', ttl=FORECAST_SLOT,
+                          max_entries=int(os.environ.get('FORECAST_CACHE_SIZE', 2000)),
+                          grace=int(os.environ.get('FORECAST_CACHE_GRACE', 60 * 30)))
+# no jitter, forecasts expire exactly on the slot boundary
+PREFETCH_TOP_N = int(os.environ.get('PREFETCH_TOP_N', 5))
+PREFETCH_DEADLINE = float(os.environ.get('PREFETCH_DEADLINE', 2.5))
+# seconds the /search page will wait for prefetched forecast/routes
+BATCH_MAX_ITEMS = 20
+# nearbysearch never returns more than 20 hikes
+BATCH_DEADLINE = float(os.environ.get('BATCH_DEADLINE', 10))
+directions_cache = TTLCache('directions', ttl=int(os.environ.get('DIRECTIONS_CACHE_TTL', 60 * 60)),
+                            max_entries=int(os.environ.get('DIRECTIONS_CACHE_SIZE', 1000)),
+                            grace=int(os.environ.get('DIRECTIONS_CACHE_GRACE', 60 * 10)), jitter=CACHE_JITTER)
+# grace: seconds an expired entry is still served while it refreshes in the background
 
 
 
 class Search(db.Model):
-    "Search Model"
+    "Search Model, one row per search a user runs"
 
-    __tablename__ = 'map_searches'
+    __tablename__ = 'search_runs'
+    __table_args__ = (
+        db.Index('ix_search_runs_user_timestamp', 'user_id', 'timestamp', 'id'),
+        # walks a user's history newest first
+        db.Index('ix_search_runs_user_address_radius', 'user_id', 'address', 'radius', 'timestamp'),
+        # checks whether a newer run of the same address/radius exists
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"))
-    name = db.Column(db.Text, nullable=False)
     address = db.Column(db.Text, nullable=False)
     radius = db.Column(db.Integer, nullable=False)
-    place_id = db.Column(db.Text, nullable=False)
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    lat = db.Column(db.Float)
+    lng = db.Column(db.Float)
+    # searches migrated from map_searches have no coords
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    results = db.relationship('SearchResult', backref='search',
+                              cascade='all, delete-orphan', passive_deletes=True)
 
     @classmethod
     def get_coords(cls, address):
-        """Given an address, returns the coords"""
+        """Given an address, returns the coords, None if Google couldn't find or answer"""
+
+        cached = GeocodeCache.lookup(address)
+        if cached:
+            return cached
+            # users repeat the same few addresses, no need to ask Google again
 
-        res = requests.get(f"{GOOGLE_GEOCODE}", params={
+        data = upstream.get_json('geocode', f"{GOOGLE_GEOCODE}", params={
             'key': google_key,
             'address': address
         })
+        if data.get('status') != 'OK' or not data.get('results'):
+            return None
+            # unknown address or Google unavailable, nothing to cache
 
-        data = res.json()
         coords = data['results'][0]['geometry']['location']
         # {'lat': 42.3292493, 'lng': -71.352353} example coords
+        GeocodeCache.store(address, coords)
 
         return coords
 
 
     @classmethod
     def get_forecast(cls, coords):
-        """Given coords, returns forecast"""
+        """Given coords, returns compact forecast (see summarize_forecast)"""
+
+        cell = cls.snap_coords(coords, grid=FORECAST_CACHE_GRID)
+        key = (cell['lat'], cell['lng'])
+
+        return forecast_cache.get_or_fetch(key, lambda: cls.fetch_forecast(cell),
+                                           ttl=cls.seconds_until_next_slot,
+                                           should_cache=lambda forecast: 'slots' in forecast)
+        # every hike in a search shares the same coords, only fetch once per slot
 
-        res = requests.get(f"{FORECAST_BASE_URL}", params={
-            'lat': coords['lat'],
-            'lon': coords['lng'],
+    @classmethod
+    def fetch_forecast(cls, cell):
+        """Asks OpenWeather for a grid cell's forecast, bypasses the cache"""
+
+        data = upstream.get_json('forecast', f"{FORECAST_BASE_URL}", params={
+            'lat': cell['lat'],
+            'lon': cell['lng'],
             'appid': weather_key
         })
 
-        return res.json()
+        if str(data.get('cod')) != '200':
+            return data
+
+        return cls.summarize_forecast(data)
+        # only the compact form is cached, raw response is ~30KB
+
+    @classmethod
+    def summarize_forecast(cls, raw_forecast):
+        """Keeps only the fields the page shows, already in display units
+
+        weather.txt has an example of the raw response"""
+
+        slots = []
+        for slot in raw_forecast['list']:
+            slot_time = datetime.strptime(slot['dt_txt'], '%Y-%m-%d %H:%M:%S')
+            slots.append({
+                'date': slot_time.strftime('%Y-%m-%d'),
+                'time': slot_time.strftime('%I:%M %p').lstrip('0'),
+                'temp': round((slot['main']['temp'] - 273.15) * 1.8 + 32),
+                # Kelvin -> F
+                'humidity': slot['main']['humidity'],
+                'clouds': slot['clouds']['all'],
+                'wind': round(slot['wind']['speed'] * 2.23694, 1),
+                # m/s -> mph
+                'pop': slot.get('pop', 0),
+                'description': slot['weather'][0]['description'],
+                'condition': slot['weather'][0]['main'],
+            })
+
+        return {'city': raw_forecast['city']['name'], 'slots': slots}
+
+    @classmethod
+    def daily_rollup(cls, slots):
+        """Rolls 3 hour slots up into one entry per day"""
+
+        days = {}
+        for slot in slots:
+            days.setdefault(slot['date'], []).append(slot)
+
+        return [{
+            'date': date,
+            'temp_min': min(slot['temp'] for slot in day_slots),
+            'temp_max': max(slot['temp'] for slot in day_slots),
+            'pop_max': max(slot['pop'] for slot in day_slots),
+            'condition': Counter(slot['condition'] for slot in day_slots).most_common(1)[0][0],
+        } for date, day_slots in days.items()]
+
+    @classmethod
+    def parse_coords(cls, data):
+        """Validates {'lat': 42.3, 'lng': -71.3} from the front end
+
+        Raises ValueError with a message for anything else"""
+
+        if not isinstance(data, dict):
+            raise ValueError('expected a json object with lat and lng')
+
+        coords = {}
+        for field, limit in (('lat', 90), ('lng', 180)):
+            value = data.get(field)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f'{field} must be a number')
+            if not -limit <= value <= limit:
+                raise ValueError(f'{field} must be between -{limit} and {limit}')
+            coords[field] = float(value)
+
+        return coords
+
+    @classmethod
+    def seconds_until_next_slot(cls, now=None):
+        """Seconds until the next 3 hour OpenWeather update (00:00, 03:00 ... UTC)"""
+
+        if now is None:
+            now = time.time()
+
+        return FORECAST_SLOT - (int(now) % FORECAST_SLOT)
+
+    @classmethod
+    def snap_coords(cls, coords, grid=None):
+        """Snaps coords to the center of their grid cell"""
+
+        if grid is None:
+            grid = HIKE_CACHE_GRID
+
+        return {'lat': round(round(coords['lat'] / grid) * grid, 6),
+                'lng': round(round(coords['lng'] / grid) * grid, 6)}
+
+    @classmethod
+    def radius_bucket(cls, radius):
+        """Returns smallest radius choice that covers the given radius"""
+
+        radius = int(float(radius))
+        for meters, miles in RADIUS_CHOICES:
+            if radius <= meters:
+                return meters
+
+        return RADIUS_CHOICES[-1][0]
 
     @classmethod
     def get_hikes(cls, coords, radius):
         """Given coords, returns hikes within a given radius"""
 
-        google_url = f"https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+        snapped = cls.snap_coords(coords)
+        radius = cls.radius_bucket(radius)
+        key = (snapped['lat'], snapped['lng'], radius)
+
+        return hike_cache.get_or_fetch(key, lambda: cls.fetch_hikes(snapped, radius),
+                                       should_cache=lambda data: data.get('status') in ('OK', 'ZERO_RESULTS'))
+        # hikes around a point barely change, serve repeat searches locally
+        # errors like OVER_QUERY_LIMIT aren't cached
+
+    @classmethod
+    def fetch_hikes(cls, snapped, radius):
+        """Asks Google for hikes around a grid cell center, bypasses the cache"""
+
         # {'lat': 42.328806, 'lng': -71.352312}
         # coords = '42.3376669449116, -71.33793080449101'
-        test_coords = f'{coords["lat"]},{coords["lng"]}'
+        # search from center of grid cell so cached result matches the key
+        test_coords = f'{snapped["lat"]},{snapped["lng"]}'
         params = {
             'location': test_coords,
             'radius': radius,
             'keyword': 'hike',
             'key': google_key}
 
-        response = requests.get(google_url, params=params)
-        return response.json()
+        return upstream.get_json('places', GOOGLE_NEARBY, params=params)
 
     @classmethod
     def show_search_results(cls, raw_search_results):
-        """Takes in json and returns instances of Result Class"""
+        """Takes in json and returns instances of SearchResult"""
         results = raw_search_results['results']
 
         search_list = []
@@ -85,15 +268,27 @@ class Search(db.Model):
             # lat = result['geometry']['location']['lat']
             # lng = result['geometry']['location']['lng']
 
-            search_obj = Search(name=name, address=address, place_id=place_id)
+            search_obj = SearchResult(name=name, place_id=place_id)
+            search_obj.address = address
+            # vicinity is only shown on the page, it isn't saved
             search_list.append(search_obj)
 
         return search_list
 
     @classmethod
     def get_directions(csl, origin_address, destination_id):
-        """Gives directions to a specific location"""
-        direction_url = 'https://maps.googleapis.com/maps/api/directions/json'
+        """Gives compact directions to a specific location (see summarize_directions)"""
+
+        key = (normalize_address(origin_address), destination_id)
+
+        return directions_cache.get_or_fetch(
+            key, lambda: csl.fetch_directions(origin_address, destination_id),
+            should_cache=lambda directions: 'steps' in directions)
+        # same hike gets clicked over and over from the same origin
+
+    @classmethod
+    def fetch_directions(cls, origin_address, destination_id):
+        """Asks Google for directions, bypasses the cache"""
 
         # place_id must be prefaced with place_id: <id here>
         # 'destination': f'place_id:{destination_id}'
@@ -104,25 +299,232 @@ class Search(db.Model):
             'key': google_key
         }
 
-        response = requests.get(direction_url, params)
-        return response.json()
+        data = upstream.get_json('directions', GOOGLE_DIRECTIONS, params)
+
+        if data.get('status') != 'OK':
+            return data
+
+        return cls.summarize_directions(data)
+        # polylines/bounds/waypoints are never used, don't keep them around
+
+    @classmethod
+    def summarize_directions(cls, raw_directions):
+        """Keeps only what the directions panel shows"""
+
+        leg = raw_directions['routes'][0]['legs'][0]
+
+        return {
+            'distance': leg['distance']['text'],
+            'duration': leg['duration']['text'],
+            'steps': [{
+                'instructions': step['html_instructions'],
+                'distance': step['distance']['text'],
+                'duration': step['duration']['text'],
+                'maneuver': step.get('maneuver'),
+                # some steps have no maneuver
+            } for step in leg['steps']],
+        }
 
     @classmethod
-    def sort_searches(csl, past_searches):
-        """Returns all unique past searches for a given user"""
+    def get_directions_batch(cls, origin_address, destination_ids, deadline=None):
+        """Gets directions to many hikes at once on the upstream pool
+
+        Returns (results, errors), both keyed by place_id, one failure
+        doesn't sink the rest of the batch"""
+
+        if deadline is None:
+            deadline = BATCH_DEADLINE
+
+        executor = upstream.get_executor()
+        # pool size (UPSTREAM_WORKERS) caps how many run in parallel
+        futures = {place_id: executor.submit(cls.get_directions, origin_address, place_id)
+                   for place_id in dict.fromkeys(destination_ids)}
 
-        sorted_searches = []
-        for count, search in enumerate(past_searches):
-        
-            search.timestamp_mod = str(search.timestamp).split(' ')[0]
-            # Changes format of timestamp without altering original timestamp
-            if count == 0:
-                sorted_searches.append(search)
-            if count > 0 and (search.address != past_searches[count-1].address or search.radius != past_searches[count-1].radius):
-                # ensures returning only unique searches.
-                sorted_searches.append(search)
+        wait(futures.values(), timeout=deadline)
 
-        return sorted_searches  
+        results = {}
+        errors = {}
+        for place_id, future in futures.items():
+            if not future.done():
+                future.cancel()
+                # unstarted ones would hold up the shared pool for later requests,
+                # a running one can't be stopped and lands in the cache
+                errors[place_id] = 'timed out'
+            elif future.exception():
+                errors[place_id] = 'upstream request failed'
+            elif 'steps' not in future.result():
+                errors[place_id] = future.result().get('status', 'no route found')
+            else:
+                results[place_id] = future.result()
+
+        return results, errors
+
+    @classmethod
+    def save_results(cls, user_id, address, radius, coords, hikes):
+        """Saves a search and its whole result set in one transaction"""
+
+        if not hikes:
+            return 0
+
+        search = cls(user_id=user_id, address=address, radius=radius,
+                     lat=coords['lat'], lng=coords['lng'])
+
+        try:
+            db.session.add(search)
+            db.session.flush()
+            # need the run id before inserting results
+
+            rows = [{'run_id': search.id, 'name': hike.name, 'place_id': hike.place_id}
+                    for hike in hikes]
+            stmt = insert(SearchResult.__table__).values(rows).on_conflict_do_nothing(
+                index_elements=['run_id', 'place_id'])
+            # Google occasionally repeats a place, skip it instead of failing the batch
+
+            result = db.session.execute(stmt)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            return 0
+
+        return result.rowcount
+
+    @classmethod
+    def route_summary(cls, directions):
+        """Pulls total distance/duration out of compact directions"""
+
+        if 'steps' not in directions:
+            return None
+            # upstream error response
+
+        return {'distance': directions['distance'], 'duration': directions['duration']}
+
+    @classmethod
+    def prefetch(cls, coords, address, hikes, top_n=None, deadline=None):
+        """Fetches area forecast and routes for top hikes concurrently
+
+        Whatever finishes before the deadline is returned for the page,
+        anything slower keeps running and lands in the caches for later clicks"""
+
+        if top_n is None:
+            top_n = PREFETCH_TOP_N
+        if deadline is None:
+            deadline = PREFETCH_DEADLINE
+
+        executor = upstream.get_executor()
+        forecast_future = executor.submit(cls.get_forecast, coords)
+        route_futures = {executor.submit(cls.get_directions, address, hike.place_id): hike.place_id
+                         for hike in hikes[:top_n]}
+
+        wait([forecast_future, *route_futures], timeout=deadline)
+
+        routes = {}
+        for future, place_id in route_futures.items():
+            if future.done() and not future.exception():
+                summary = cls.route_summary(future.result())
+                if summary:
+                    routes[place_id] = summary
+
+        forecast = None
+        if forecast_future.done() and not forecast_future.exception():
+            forecast = forecast_future.result()
+
+        return {'forecast': forecast, 'routes': routes}
+
+    @classmethod
+    def past_searches(cls, user_id, limit=20, before=None, after=None):
+        """Returns newest run of each unique address/radius for a user, newest first
+
+        before/after are (timestamp, id) keys from a page cursor, the index is
+        entered right at the cursor so cost doesn't grow with history depth"""
+
+        newer = aliased(cls)
+        newer_exists = db.session.query(newer.id).filter(
+            newer.user_id == cls.user_id,
+            newer.address == cls.address,
+            newer.radius == cls.radius,
+            tuple_(newer.timestamp, newer.id) > tuple_(cls.timestamp, cls.id)).exists()
+        # a run is only shown if no newer run repeats its address/radius
+
+        query = cls.query.filter(cls.user_id == user_id, ~newer_exists)
+
+        if after is not None:
+            # walking back towards newer searches, flip order then flip results back
+            searches = (query.filter(tuple_(cls.timestamp, cls.id) > tuple_(*after))
+                        .order_by(cls.timestamp.asc(), cls.id.asc())
+                        .limit(limit)
+                        .all())
+            return searches[::-1]
+
+        if before is not None:
+            query = query.filter(tuple_(cls.timestamp, cls.id) < tuple_(*before))
+
+        return query.order_by(cls.timestamp.desc(), cls.id.desc()).limit(limit).all()
+
+    @classmethod
+    def last_searched(cls, user_id):
+        """Timestamp of a user's newest search, None if they have none"""
+
+        return db.session.query(db.func.max(cls.timestamp)).filter(
+            cls.user_id == user_id).scalar()
+
+    @classmethod
+    def past_searches_page(cls, user_id, per_page=20, before=None, after=None):
+        """Returns one page of past searches plus cursors for next/prev links"""
+
+        before = cls.parse_cursor(before)
+        after = cls.parse_cursor(after)
+
+        searches = cls.past_searches(user_id, per_page + 1, before=before, after=after)
+        # one extra row tells us whether another page exists
+
+        has_more = len(searches) > per_page
+        if after is not None:
+            searches = searches[-per_page:] if has_more else searches
+            has_newer, has_older = has_more, True
+        else:
+            searches = searches[:per_page]
+            has_newer, has_older = before is not None, has_more
+
+        return {
+            'searches': searches,
+            'newer': cls.make_cursor(searches[0]) if searches and has_newer else None,
+            'older': cls.make_cursor(searches[-1]) if searches and has_older else None,
+        }
+
+    @classmethod
+    def make_cursor(cls, search):
+        """Cursor for a page boundary, '2021-10-15T12:00:00.000001_42'"""
+
+        return f"{search.timestamp.isoformat()}_{search.id}"
+
+    @classmethod
+    def parse_cursor(cls, cursor):
+        """Turns a cursor back into a (timestamp, id) key, None if missing/invalid"""
+
+        if not cursor:
+            return None
+
+        try:
+            timestamp, search_id = cursor.rsplit('_', 1)
+            return (datetime.fromisoformat(timestamp), int(search_id))
+        except ValueError:
+            return None
+
+    def __repr__(self):
+        return f"<Search #{self.id}: user_id: {self.user_id}, address: {self.address}, radius: {self.radius}, timestamp: {self.timestamp}>"
+
+
+class SearchResult(db.Model):
+    "One hike returned by a search"
+
+    __tablename__ = 'search_results'
+    __table_args__ = (db.UniqueConstraint('run_id', 'place_id'),)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('search_runs.id', ondelete="cascade"),
+                       nullable=False)
+    place_id = db.Column(db.Text, nullable=False)
+    name = db.Column(db.Text, nullable=False)
 
     def __repr__(self):
-        return f"<Search #{self.id}: user_id: {self.user_id}, name: {self.name}, address: {self.address}, radius: {self.radius}, place_id: {self.place_id}, timestamp: {self.timestamp}>"       
+        return f"<SearchResult #{self.id}: run_id: {self.run_id}, name: {self.name}, place_id: {self.place_id}>"       
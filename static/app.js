@@ -1,4 +1,28 @@
-
+// Directions to every hike on the page, only fetched in one batch request
+// when the user asks for all of them, each one is a billable Google call
+let batchDirections = {};
+
+const allDirectionsButton = document.querySelector('#all-directions-button');
+
+if (allDirectionsButton) {
+    allDirectionsButton.addEventListener('click', async function () {
+        const placeIds = Array.from(
+            document.querySelectorAll('#directions-container > div'), div => div.id);
+
+        allDirectionsButton.disabled = true;
+        try {
+            const res = await axios.post('/search/details/batch', {
+                'origin_address': document.querySelector('h2').id,
+                'destination_ids': placeIds
+            });
+            batchDirections = res.data.results || {};
+            allDirectionsButton.innerText = 'Directions loaded';
+        } catch (err) {
+            // clicks still work one at a time through /search/details
+            allDirectionsButton.disabled = false;
+        }
+    });
+}
 
 // When <li> clicked send id or data-attr to backend
 document.querySelector('#directions-container').addEventListener('click', async function (e) {
@@ -7,21 +31,31 @@ document.querySelector('#directions-container').addEventListener('click', async
         const placeId = e.target.closest('div').id;
         const originAddress = document.querySelector('h2').id;
 
-        const res = await axios.post('/search/details', {
-            'destination_id': placeId,
-            'origin_address': originAddress
-        });
-        const dist = res.data.routes[0].legs[0].distance.text;
-        const steps = res.data.routes[0].legs[0].steps;
+        let directions = batchDirections[placeId];
+
+        if (directions === undefined) {
+            // fetch just this hike, the batch only runs from its own button
+            // GET so the browser can revalidate cached responses
+            const res = await axios.get('/search/details', {
+                params: {
+                    'destination_id': placeId,
+                    'origin_address': originAddress
+                }
+            });
+            directions = res.data;
+        }
 
-        appendDirections(steps, dist);
+        appendDirections(directions.steps, directions.distance);
     }
 
     // If user clicks "Get Forecast" perform following steps
     if (e.target.classList.contains('forecast-button')) {
-        const coords = e.target.closest('div').getAttribute('data-coords');
-        const forecast_res = await axios.post('/search/forecast', {
-            'coords': coords
+        const hikeDiv = e.target.closest('div');
+        const forecast_res = await axios.get('/search/forecast', {
+            params: {
+                'lat': hikeDiv.dataset.lat,
+                'lng': hikeDiv.dataset.lng
+            }
         })
 
         appendForecast(forecast_res)
@@ -41,9 +75,9 @@ function appendDirections(steps, dist) {
 
     // Loop through list array, make each step an <li>
     for (let i = 0; i < steps.length; i++) {
-        const direction = steps[i].html_instructions;
-        const stepDist = steps[i].distance.text;
-        const stepDuration = steps[i].duration.text;
+        const direction = steps[i].instructions;
+        const stepDist = steps[i].distance;
+        const stepDuration = steps[i].duration;
         const stepManuever = steps[i].maneuver;
 
         const directionPara = document.createElement('p');
@@ -60,8 +94,8 @@ function appendDirections(steps, dist) {
         listElement.append(distPara);
         listElement.append(durationPara);
 
-        // Some steps have undefined manuever
-        if (stepManuever !== undefined) {
+        // Some steps have no manuever
+        if (stepManuever) {
             const manueverPara = document.createElement('p');
             manueverPara.innerHTML = `<b>Manuever: </b>${stepManuever}`;
             listElement.append(manueverPara)
@@ -82,25 +116,22 @@ function appendDirections(steps, dist) {
 function appendForecast(forecast) {
     
     const forecastDisplay = document.querySelector('#forecast-display')
-    const forecastList = forecast.data.list
+    const forecastList = forecast.data.slots
     forecastDisplay.innerHTML = ''
     const h2 = document.createElement('h2')
     h2.innerText = 'Forecast'
     h2.style.marginLeft = '30%'
     forecastDisplay.append(h2)
 
+    // server already converted units and picked out the fields we show
     for (let i = 0; i < forecastList.length; i++) {
-        const datetime = forecastList[i].dt_txt
-        const dateArr = datetime.split(' ');
-        const time = convertTime(dateArr[1]);
-        const dateStr = `${dateArr[0]}`
-        const timeStr = `${time}`
-        const cloudCover = forecastList[i].clouds.all
-        const humidity = forecastList[i].main.humidity
-        const tempKelvin = forecastList[i].main.temp
-        const temp = Math.round(((tempKelvin - 273.15) * 1.8) + 32)
-        const description = forecastList[i].weather[0].description
-        const wind = forecastList[i].wind.speed
+        const dateStr = forecastList[i].date
+        const timeStr = forecastList[i].time
+        const cloudCover = forecastList[i].clouds
+        const humidity = forecastList[i].humidity
+        const temp = forecastList[i].temp
+        const description = forecastList[i].description
+        const wind = forecastList[i].wind
 
         const datePara = document.createElement('p');
         datePara.innerHTML = `<b>Date: </b>${dateStr}`;
@@ -143,7 +174,3 @@ function appendForecast(forecast) {
     forecastDiv.classList.remove('invisible')
 }
 
-function convertTime(militaryTime) {
-    return moment(militaryTime, 'HH:mm:ss').format('h:mm A');
-}
-
@@ -0,0 +1,304 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+
+from unittest import TestCase
+from unittest.mock import patch
+import itertools
+import os
+import tempfile
+import threading
+import time
+from cache import TTLCache, cache_stats
+from cache_backends import (MemoryBackend, SQLiteBackend, NetworkBackend, PickleSerializer,
+                            TOUCH_INTERVAL)
+import cache_server
+from search import Search
+import search
+
+
+class TTLCacheTestCase(TestCase):
+    """Test in-process cache."""
+
+    def setUp(self):
+        """Create a small cache."""
+
+        self.cache = TTLCache('test', ttl=60, max_entries=2)
+        self.cache.clear()
+
+    def test_get_set(self):
+        """Do stored values come back"""
+
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_expiry(self):
+        """Are expired values treated as misses"""
+
+        with patch('cache.time.time', return_value=1000):
+            self.cache.set('a', 1)
+
+        with patch('cache.time.time', return_value=1061):
+            misses = cache_stats['test']['misses']
+            self.assertIsNone(self.cache.get('a'))
+            self.assertEqual(cache_stats['test']['misses'], misses + 1)
+
+    def test_lru_eviction(self):
+        """Is least recently used key evicted when full"""
+
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_stale_while_revalidate(self):
+        """Is a stale value served while it refreshes in the background"""
+
+        cache = TTLCache('test_swr', ttl=60, max_entries=10, grace=60)
+
+        with patch('cache.time.time', return_value=1000):
+            cache.set('a', 'old')
+
+        release = threading.Event()
+
+        def fetch():
+            release.wait(1)
+            return 'new'
+
+        with patch('cache.time.time', return_value=1070):
+            self.assertEqual(cache.get_or_fetch('a', fetch), 'old')
+            # served before the refresh has finished
+            release.set()
+
+            for i in range(100):
+                if 'a' not in cache.refreshing:
+                    break
+                time.sleep(0.01)
+
+            self.assertEqual(cache.get('a'), 'new')
+
+    def test_past_grace(self):
+        """Is a value past its grace window fetched inline"""
+
+        cache = TTLCache('test_swr', ttl=60, max_entries=10, grace=60)
+
+        with patch('cache.time.time', return_value=1000):
+            cache.set('a', 'old')
+
+        with patch('cache.time.time', return_value=1121):
+            self.assertEqual(cache.get_or_fetch('a', lambda: 'new'), 'new')
+
+    def test_jitter(self):
+        """Are ttls cut by no more than the jitter fraction"""
+
+        cache = TTLCache('test_jitter', ttl=100, max_entries=100, jitter=0.1)
+
+        with patch('cache.time.time', return_value=1000):
+            for i in range(50):
+                cache.set(i, i)
+
+        expiries = [cache.backend.get('test_jitter', i)[0] for i in range(50)]
+        self.assertTrue(all(1090 <= expires_at <= 1100 for expires_at in expiries))
+        self.assertGreater(len(set(expiries)), 1)
+
+    def test_no_jitter_for_computed_ttl(self):
+        """Do ttls worked out per value (forecast slots) expire exactly on time"""
+
+        cache = TTLCache('test_jitter_slot', ttl=100, max_entries=100, jitter=0.5)
+
+        with patch('cache.time.time', return_value=1000):
+            for i in range(20):
+                cache.get_or_fetch(i, lambda: 'forecast', ttl=lambda: 200)
+
+        expiries = {cache.backend.get('test_jitter_slot', i)[0] for i in range(20)}
+        self.assertEqual(expiries, {1200})
+
+
+class MemoryBackendTestCase(TestCase):
+    """Test each backend stores, expires and evicts the same way."""
+
+    def make_backend(self):
+        return MemoryBackend()
+
+    def setUp(self):
+        """Create a small cache on this backend."""
+
+        self.backend = self.make_backend()
+        self.cache = TTLCache('test_backend', ttl=60, max_entries=2, backend=self.backend)
+        self.cache.clear()
+
+    def test_get_set(self):
+        """Do stored values come back the same"""
+
+        self.cache.set(('101 loker st', 5000), {'status': 'OK', 'results': [1, 2]})
+        self.assertEqual(self.cache.get(('101 loker st', 5000)),
+                         {'status': 'OK', 'results': [1, 2]})
+        self.assertIsNone(self.cache.get(('101 loker st', 8000)))
+
+        self.cache.delete(('101 loker st', 5000))
+        self.assertIsNone(self.cache.get(('101 loker st', 5000)))
+
+    def test_expiry(self):
+        """Are expired values treated as misses"""
+
+        with patch('cache.time.time', return_value=1000):
+            self.cache.set('a', 1)
+
+        with patch('cache.time.time', return_value=1061):
+            self.assertIsNone(self.cache.get('a'))
+
+    def test_lru_eviction(self):
+        """Is least recently used key evicted when full"""
+
+        evictions = cache_stats['test_backend']['evictions']
+
+        with patch('time.time', side_effect=itertools.count(1000)):
+            # sqlite orders by last_used, every call gets a later timestamp
+            self.cache.set('a', 1)
+            self.cache.set('b', 2)
+            self.cache.get('a')
+            self.cache.set('c', 3)
+
+            self.assertEqual(len(self.cache), 2)
+            self.assertIsNone(self.cache.get('b'))
+            self.assertEqual(self.cache.get('a'), 1)
+
+        self.assertEqual(cache_stats['test_backend']['evictions'], evictions + 1)
+
+    def test_namespaces(self):
+        """Do caches sharing a backend keep their own keys"""
+
+        other = TTLCache('test_backend_other', ttl=60, max_entries=2, backend=self.backend)
+        other.clear()
+
+        self.cache.set('a', 1)
+        other.set('a', 2)
+        self.cache.clear()
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(other.get('a'), 2)
+
+
+class SQLiteBackendTestCase(MemoryBackendTestCase):
+
+    def make_backend(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        return SQLiteBackend(os.path.join(self.dir.name, 'cache.db'))
+
+    def test_shared_between_instances(self):
+        """Does a second connection to the file (another worker) see the entry"""
+
+        self.cache.set('a', 1)
+        other = SQLiteBackend(self.backend.path)
+        self.assertEqual(other.get('test_backend', 'a')[2], 1)
+
+    def test_lru_eviction(self):
+        with patch('cache_backends.TOUCH_INTERVAL', 0):
+            super().test_lru_eviction()
+
+    def test_touch_interval(self):
+        """Is last_used only rewritten once per TOUCH_INTERVAL"""
+
+        def last_used():
+            return self.backend.connection().execute(
+                'SELECT last_used FROM cache_entries WHERE key = ?', ('"a"',)).fetchone()[0]
+
+        with patch('time.time', return_value=1000):
+            self.backend.set('test_backend', 'a', (5000, 5000, 1), 2)
+        with patch('time.time', return_value=1030):
+            self.assertEqual(self.backend.get('test_backend', 'a')[2], 1)
+        self.assertEqual(last_used(), 1000)
+        # a hit inside the interval is read only
+
+        with patch('time.time', return_value=1000 + TOUCH_INTERVAL):
+            self.backend.get('test_backend', 'a')
+        self.assertEqual(last_used(), 1000 + TOUCH_INTERVAL)
+
+    def test_serializer_changed(self):
+        """Are values written by another serializer misses instead of errors"""
+
+        pickled = SQLiteBackend(self.backend.path, PickleSerializer())
+        pickled.set('test_backend', 'a', (time.time() + 60, time.time() + 60, {'x': 1}), 2)
+
+        self.assertIsNone(self.backend.get('test_backend', 'a'))
+        self.assertIsNone(self.cache.get('a'))
+
+        self.cache.set('a', 2)
+        self.assertEqual(self.cache.get('a'), 2)
+
+
+class NetworkBackendTestCase(MemoryBackendTestCase):
+
+    def make_backend(self):
+        self.server = cache_server.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        return NetworkBackend(*self.server.server_address)
+
+    def test_server_down(self):
+        """Does an unreachable server act like an empty cache"""
+
+        self.server.shutdown()
+        self.server.server_close()
+        backend = NetworkBackend(*self.server.server_address)
+
+        self.assertIsNone(backend.get('test_backend', 'a'))
+        self.assertEqual(backend.set('test_backend', 'a', (0, 0, 1), 2), 0)
+
+    def test_serializer_changed(self):
+        """Are values written by another serializer misses instead of errors"""
+
+        pickled = NetworkBackend(*self.server.server_address, serializer=PickleSerializer())
+        pickled.set('test_backend', 'a', (time.time() + 60, time.time() + 60, {'x': 1}), 2)
+
+        self.assertIsNone(self.backend.get('test_backend', 'a'))
+        self.assertIsNone(self.cache.get('a'))
+
+
+class HikeCacheKeyTestCase(TestCase):
+    """Test how hike searches are bucketed."""
+
+    def test_snap_coords(self):
+        """Do nearby coords land in the same grid cell"""
+
+        c1 = Search.snap_coords({'lat': 42.3292493, 'lng': -71.352353}, grid=0.01)
+        c2 = Search.snap_coords({'lat': 42.3281, 'lng': -71.3489}, grid=0.01)
+        self.assertEqual(c1, c2)
+        self.assertEqual(c1, {'lat': 42.33, 'lng': -71.35})
+
+    def test_directions_cache_key(self):
+        """Do repeat clicks from the same origin skip Google"""
+
+        search.directions_cache.clear()
+        search.directions_cache.set(('101 loker st', 'place_id1'), {'status': 'OK'})
+
+        with patch('search.upstream.get_json') as mock_get:
+            directions = Search.get_directions(' 101 Loker St', 'place_id1')
+            self.assertEqual(directions, {'status': 'OK'})
+            mock_get.assert_not_called()
+
+    def test_forecast_slot_expiry(self):
+        """Do forecasts expire on the next 3 hour boundary"""
+
+        midnight = 1634256000
+        # 2021-10-15 00:00:00 UTC
+        self.assertEqual(Search.seconds_until_next_slot(midnight), 10800)
+        self.assertEqual(Search.seconds_until_next_slot(midnight + 3600), 7200)
+        self.assertEqual(Search.seconds_until_next_slot(midnight + 10799), 1)
+
+    def test_radius_bucket(self):
+        """Are radii rounded up to a radius choice"""
+
+        self.assertEqual(Search.radius_bucket(5000), 5000)
+        self.assertEqual(Search.radius_bucket('6000'), 8000)
+        self.assertEqual(Search.radius_bucket(99999), 32000)
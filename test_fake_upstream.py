@@ -0,0 +1,115 @@
+"""Fake upstream tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fake_upstream.py
+
+
+
+from unittest import TestCase
+from unittest.mock import patch
+from urllib.parse import urlsplit
+from search import Search
+import fake_upstream
+import search
+
+
+class FakeUpstreamTestCase(TestCase):
+    """Test the stand-in Google/OpenWeather server."""
+
+    def setUp(self):
+        """Reset injected faults and route search.py's calls to the fake."""
+
+        fake_upstream.config.update(latency=0, jitter=0, error_rate=0, rate_limit=0,
+                                    max_per_second=0)
+        fake_upstream.stats.clear()
+        self.client = fake_upstream.app.test_client()
+
+        search.forecast_cache.clear()
+        search.directions_cache.clear()
+        search.hike_cache.clear()
+
+        def fake_get_json(endpoint, url, params):
+            resp = self.client.get(urlsplit(url).path, query_string=params)
+            return resp.get_json()
+
+        patcher = patch('search.upstream.get_json', side_effect=fake_get_json)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_urls_match_fake_routes(self):
+        """Do the configured endpoint paths exist on the fake"""
+
+        for url in (search.GOOGLE_GEOCODE, search.GOOGLE_NEARBY, search.GOOGLE_DIRECTIONS,
+                    search.FORECAST_BASE_URL):
+            resp = self.client.get(urlsplit(url).path)
+            self.assertNotEqual(resp.status_code, 404, url)
+
+    def test_search_flow(self):
+        """Can hikes, directions and a forecast be fetched and parsed"""
+
+        with patch('search.GeocodeCache.lookup', return_value=None), \
+                patch('search.GeocodeCache.store'):
+            coords = Search.get_coords('101 Loker St')
+
+        self.assertEqual(coords, fake_upstream.geocode_response(' 101  loker st')
+                         ['results'][0]['geometry']['location'])
+        hikes = Search.show_search_results(Search.get_hikes(coords, 8000))
+        self.assertTrue(1 <= len(hikes) <= 20)
+
+        directions = Search.get_directions('101 Loker St', hikes[0].place_id)
+        self.assertIn('steps', directions)
+        self.assertTrue(directions['steps'][0]['instructions'])
+
+        forecast = Search.get_forecast(coords)
+        self.assertEqual(len(forecast['slots']), 40)
+        self.assertEqual(forecast['city'], 'Wayland')
+
+    def test_repeatable(self):
+        """Does the same query always get the same answer"""
+
+        first = fake_upstream.nearby_response('42.33,-71.35', 5000, 'hike')
+        second = fake_upstream.nearby_response('42.33,-71.35', 5000, 'hike')
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, fake_upstream.nearby_response('42.34,-71.35', 5000, 'hike'))
+
+    def test_forecast_starts_at_next_slot(self):
+        """Is the weather.txt sample moved to the future"""
+
+        forecast = fake_upstream.forecast_response(42.3, -71.3, now=1634256000 + 60)
+        self.assertEqual(forecast['list'][0]['dt'], 1634256000 + 10800)
+        self.assertEqual(forecast['list'][0]['dt_txt'], '2021-10-15 03:00:00')
+
+    def test_rate_limit(self):
+        """Are rate limited requests answered like the real APIs and not cached"""
+
+        fake_upstream.config['rate_limit'] = 1
+
+        resp = self.client.get('/data/2.5/forecast', query_string={'lat': 1, 'lon': 1})
+        self.assertEqual(resp.status_code, 429)
+
+        data = Search.get_hikes({'lat': 42.33, 'lng': -71.35}, 5000)
+        self.assertEqual(data['status'], 'OVER_QUERY_LIMIT')
+        self.assertEqual(len(search.hike_cache), 0)
+        self.assertEqual(fake_upstream.stats['places']['rate_limited'], 1)
+
+    def test_max_per_second(self):
+        """Are requests past the per second limit turned away"""
+
+        fake_upstream.config['max_per_second'] = 2
+
+        with patch('fake_upstream.time.time', return_value=1000):
+            statuses = [self.client.get('/maps/api/geocode/json',
+                                        query_string={'address': 'x'}).get_json()['status']
+                        for i in range(3)]
+
+        self.assertEqual(statuses, ['OK', 'OK', 'OVER_QUERY_LIMIT'])
+
+    def test_errors(self):
+        """Are injected errors 500s"""
+
+        fake_upstream.config['error_rate'] = 1
+
+        resp = self.client.get('/maps/api/directions/json')
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(fake_upstream.stats['directions']['errors'], 1)
@@ -0,0 +1,112 @@
+"""Password hashing pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_hashing.py
+
+
+
+from unittest import TestCase
+from unittest.mock import patch
+import os
+import signal
+import tempfile
+import time
+import hashing
+
+
+class HashingTestCase(TestCase):
+    """Test off-thread bcrypt."""
+
+    def test_generate_and_check(self):
+        """Can a hash made on the pool be checked on the pool"""
+
+        hashed = hashing.generate_password_hash('password1', 4)
+        self.assertTrue(hashed.startswith('$2b$04$'))
+        self.assertTrue(hashing.check_password_hash(hashed, 'password1'))
+        self.assertFalse(hashing.check_password_hash(hashed, 'wrong_password'))
+
+    def test_empty_password(self):
+        """Is an empty password rejected like Flask-Bcrypt did"""
+
+        self.assertRaises(ValueError, hashing.generate_password_hash, None, 4)
+
+    def test_wait_metrics(self):
+        """Are completed hashes and wait times counted"""
+
+        completed = hashing.hash_stats['completed']
+        hashing.generate_password_hash('password1', 4)
+
+        self.assertEqual(hashing.hash_stats['completed'], completed + 1)
+        self.assertGreaterEqual(hashing.hash_stats['max_wait_ms'], 0)
+        self.assertEqual(hashing.hash_stats['queue_depth'], 0)
+
+    def test_queue_full(self):
+        """Are requests turned away once the queue is full"""
+
+        rejected = hashing.hash_stats['rejected']
+
+        with patch('hashing.HASH_QUEUE_LIMIT', 0):
+            self.assertRaises(hashing.HashQueueFull,
+                              hashing.check_password_hash, '$2b$04$x', 'password1')
+
+        self.assertEqual(hashing.hash_stats['rejected'], rejected + 1)
+
+    def test_timeout(self):
+        """Does a slow hash turn into HashQueueFull and keep its queue slot until it's done"""
+
+        hashed = hashing.generate_password_hash('password1', 12)
+        timeouts = hashing.hash_stats['timeouts']
+
+        with patch('hashing.HASH_TIMEOUT', 0.001), patch('hashing.HASH_EXECUTOR', 'process'):
+            self.assertRaises(hashing.HashQueueFull,
+                              hashing.check_password_hash, hashed, 'password1')
+
+        self.assertEqual(hashing.hash_stats['timeouts'], timeouts + 1)
+        self.assertEqual(hashing.hash_stats['queue_depth'], 1)
+        # still running on the pool
+
+        for i in range(100):
+            if hashing.hash_stats['queue_depth'] == 0:
+                break
+            time.sleep(0.05)
+        self.assertEqual(hashing.hash_stats['queue_depth'], 0)
+
+    def test_broken_pool(self):
+        """Is the pool rebuilt after one of its processes dies"""
+
+        with patch('hashing.HASH_EXECUTOR', 'process'):
+            hashing.generate_password_hash('password1', 4)
+            executor = hashing.get_executor()
+            for process in list(executor._processes.values()):
+                os.kill(process.pid, signal.SIGKILL)
+
+            try:
+                hashing.generate_password_hash('password1', 4)
+            except hashing.HashQueueFull:
+                pass
+                # the hash in flight when the child died is turned away
+
+            self.assertIsNot(hashing.get_executor(), executor)
+            hashed = hashing.generate_password_hash('password1', 4)
+            self.assertTrue(hashing.check_password_hash(hashed, 'password1'))
+
+    def test_machine_slots(self):
+        """Is a hash turned away while every machine-wide slot is taken"""
+
+        hashed = hashing.generate_password_hash('password1', 4)
+        no_slot = hashing.hash_stats['no_slot']
+
+        with tempfile.TemporaryDirectory() as slot_dir, \
+                patch('hashing.HASH_SLOT_DIR', slot_dir), patch('hashing.HASH_SLOTS', 1), \
+                patch('hashing.HASH_SLOT_WAIT', 0):
+            held = hashing.acquire_slot()
+            # stands in for another worker, flock()s on separate opens conflict like processes do
+            self.assertRaises(hashing.HashQueueFull,
+                              hashing.check_password_hash, hashed, 'password1')
+            self.assertEqual(hashing.hash_stats['no_slot'], no_slot + 1)
+
+            held.close()
+            self.assertTrue(hashing.check_password_hash(hashed, 'password1'))
+            self.assertIsNotNone(hashing.acquire_slot())
+            # freed again after the hash
@@ -0,0 +1,68 @@
+"""Load test harness tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loadtest.py
+
+
+
+from unittest import TestCase
+from unittest.mock import Mock, patch
+import loadtest
+
+
+class LoadTestReportTestCase(TestCase):
+    """Test how load test samples are summarized and compared."""
+
+    def test_percentile(self):
+        """Are nearest-rank percentiles picked from the sorted samples"""
+
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 95), 95)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile([7], 99), 7)
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_summarize(self):
+        """Are counts, throughput and latencies (ms) reported"""
+
+        samples = [(0.010, True), (0.020, True), (0.030, False), (0.040, True)]
+        stats = loadtest.summarize(samples, elapsed=2)
+
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['rps'], 2)
+        self.assertEqual(stats['p50'], 20)
+        self.assertEqual(stats['p99'], 40)
+
+    def test_compare(self):
+        """Are slower percentiles and lower throughput flagged as regressions"""
+
+        def result(p95, rps):
+            stats = {'p50': 10, 'p95': p95, 'p99': 50, 'rps': rps}
+            return {'label': 'x', 'total': stats, 'routes': {'GET /search/past': stats}}
+
+        rows = loadtest.compare(result(20, 100), result(30, 100), threshold=10)
+        regressed = {(route, stat) for route, stat, *rest, flag in rows if flag}
+        self.assertEqual(regressed, {('GET /search/past', 'p95'), ('total', 'p95')})
+
+        rows = loadtest.compare(result(20, 100), result(20, 80), threshold=10)
+        regressed = {(route, stat) for route, stat, *rest, flag in rows if flag}
+        self.assertEqual(regressed, {('GET /search/past', 'rps'), ('total', 'rps')})
+
+        rows = loadtest.compare(result(20, 100), result(15, 120), threshold=10)
+        self.assertFalse(any(row[-1] for row in rows))
+
+    def test_failed_register_redirect(self):
+        """Is a register that redirects back to /register counted as an error"""
+
+        recorder = loadtest.Recorder()
+        user = loadtest.User('http://localhost:5000', recorder, ['101 loker st'], 3)
+
+        for location, ok in (('/register', False), ('/search', True)):
+            resp = Mock(status_code=302, headers={'Location': location})
+            with patch.object(user.session, 'request', return_value=resp):
+                user.request('POST', '/register', ok_statuses=(302,), redirect_to='/search')
+
+            self.assertEqual(recorder.samples['POST /register'][-1][1], ok)
@@ -6,12 +6,14 @@
 
 
 
+import ast
 import os
 from unittest import TestCase
 from flask.json import jsonify
 from sqlalchemy import exc
 from user import db, User
-from search import Search
+from search import Search, SearchResult
+from cache import GeocodeCache, cache_stats
 
 os.environ['DATABASE_URL'] = "postgresql:///weather_test"
 from app import app
@@ -47,13 +49,13 @@ class UserModelTestCase(TestCase):
         self.u2 = u2
         self.uid2 = uid2
         
-        s1 = Search(user_id=u1.id, name='hike_name', address='hike_address',
-                                 radius='5000', place_id='place_id1', timestamp=None)
+        s1 = Search(user_id=u1.id, address='hike_address', radius='5000', timestamp=None,
+                    results=[SearchResult(name='hike_name', place_id='place_id1')])
         sid1 = 1111
         s1.id = sid1     
 
-        s2 = Search(user_id=u1.id, name='hike_name2', address='hike_address2',
-                                 radius='5000', place_id='place_id1', timestamp=None)
+        s2 = Search(user_id=u1.id, address='hike_address2', radius='5000', timestamp=None,
+                    results=[SearchResult(name='hike_name2', place_id='place_id1')])
         sid2 = 2222
         s2.id = sid2  
 
@@ -75,15 +77,15 @@ class UserModelTestCase(TestCase):
         """Does basic model work?"""
 
         # Search should have attrs given to it 
-        self.assertEqual(self.s1.name, 'hike_name')
         self.assertEqual(self.s1.address, 'hike_address')
         self.assertEqual(self.s1.radius, 5000)
-        self.assertEqual(self.s1.place_id, 'place_id1')
+        self.assertEqual(self.s1.results[0].name, 'hike_name')
+        self.assertEqual(self.s1.results[0].place_id, 'place_id1')
 
     def test_repr(self):
         """Does repr work?"""
         
-        self.assertIn('<Search #1111: user_id: 1111, name: hike_name, address: hike_address, radius: 5000, place_id: place_id1,' , repr(self.s1))
+        self.assertIn('<Search #1111: user_id: 1111, address: hike_address, radius: 5000,' , repr(self.s1))
 
     def test_get_coords(self):
         """Given an address, can we get correct coords"""
@@ -96,7 +98,24 @@ class UserModelTestCase(TestCase):
 
         coords = {'lat': 42.3292493, 'lng': -71.352353}
         forecast = Search.get_forecast(coords)       
-        self.assertIn('humidity', forecast['list'][0]['main'])
+        self.assertIn('humidity', forecast['slots'][0])
+
+    def test_summarize_forecast(self):
+        """Is raw OpenWeather json cut down to display fields"""
+
+        with open('weather.txt') as f:
+            text = f.read()
+        raw = ast.literal_eval(text[text.index('{'):])
+
+        summary = Search.summarize_forecast(raw)
+        self.assertEqual(summary['city'], 'Wayland')
+        self.assertEqual(len(summary['slots']), len(raw['list']))
+        self.assertEqual(summary['slots'][0]['time'], '9:00 PM')
+        self.assertNotIn('main', summary['slots'][0])
+
+        days = Search.daily_rollup(summary['slots'])
+        self.assertEqual(days[0]['date'], '2021-10-15')
+        self.assertLessEqual(days[1]['temp_min'], days[1]['temp_max'])
 
     def test_get_hikes(self):
         """Given coords and radius, can we get hikes"""
@@ -115,7 +134,7 @@ class UserModelTestCase(TestCase):
         raw_results = Search.get_hikes(coords, radius)
         hikes = Search.show_search_results(raw_results)
         search_obj = hikes[0]
-        self.assertIsInstance(search_obj, Search)
+        self.assertIsInstance(search_obj, SearchResult)
 
     def test_get_directions(self):
         """Given an address and a destination_id can we get directions"""
@@ -124,16 +143,99 @@ class UserModelTestCase(TestCase):
         dest_id = 'ChIJVxwHDsyF44kR2sqNCPwrBYk'
 
         directions = Search.get_directions(address, dest_id)
-        self.assertIn('place_id', directions['geocoded_waypoints'][0])
+        self.assertIn('instructions', directions['steps'][0])
+        self.assertNotIn('geocoded_waypoints', directions)
+
+    def test_summarize_directions(self):
+        """Is a directions response cut down to what the page shows"""
+
+        raw = {'geocoded_waypoints': [{'place_id': 'abc'}], 'status': 'OK',
+               'routes': [{'overview_polyline': {'points': 'xyz'}, 'bounds': {},
+                           'legs': [{'distance': {'text': '5.2 mi', 'value': 8400},
+                                     'duration': {'text': '12 mins', 'value': 700},
+                                     'steps': [{'html_instructions': 'Head <b>north</b>',
+                                                'distance': {'text': '0.1 mi'},
+                                                'duration': {'text': '1 min'},
+                                                'polyline': {'points': 'abc'}}]}]}]}
+
+        directions = Search.summarize_directions(raw)
+        self.assertEqual(directions, {
+            'distance': '5.2 mi', 'duration': '12 mins',
+            'steps': [{'instructions': 'Head <b>north</b>', 'distance': '0.1 mi',
+                       'duration': '1 min', 'maneuver': None}]})
+
+    def test_past_searches(self):
+        """Given a user can we get their unique searches newest first"""
+
+        past_searches = Search.past_searches(self.u1.id)
+        self.assertEqual(len(past_searches), 2)
+
+        repeat = Search(user_id=self.u1.id, address='hike_address', radius=5000)
+        db.session.add(repeat)
+        db.session.commit()
+
+        past_searches = Search.past_searches(self.u1.id)
+        self.assertEqual(len(past_searches), 2)
+        self.assertEqual(past_searches[0].id, repeat.id)
+        # repeat of an old search replaces it at the top
+
+        past_searches = Search.past_searches(self.u2.id)
+        self.assertEqual(len(past_searches), 0)
+
+    def test_past_searches_page(self):
+        """Can we page through past searches with cursors"""
+
+        first = Search.past_searches_page(self.u1.id, per_page=1)
+        self.assertEqual(len(first['searches']), 1)
+        self.assertIsNone(first['newer'])
+        self.assertIsNotNone(first['older'])
+
+        second = Search.past_searches_page(self.u1.id, per_page=1, before=first['older'])
+        self.assertEqual(len(second['searches']), 1)
+        self.assertNotEqual(second['searches'][0].id, first['searches'][0].id)
+        self.assertIsNone(second['older'])
+
+        back = Search.past_searches_page(self.u1.id, per_page=1, after=second['newer'])
+        self.assertEqual(back['searches'][0].id, first['searches'][0].id)
+
+    def test_save_results(self):
+        """Is a search saved as one run with its results"""
+
+        hikes = [SearchResult(name='hike_a', place_id='place_a'),
+                 SearchResult(name='hike_b', place_id='place_b'),
+                 SearchResult(name='hike_b', place_id='place_b')]
+        coords = {'lat': 42.3292493, 'lng': -71.352353}
+
+        saved = Search.save_results(self.u2.id, 'new_address', 8000, coords, hikes)
+        self.assertEqual(saved, 2)
+        # repeated place is skipped, not an error
+
+        searches = Search.query.filter_by(user_id=self.u2.id).all()
+        self.assertEqual(len(searches), 1)
+        self.assertEqual(searches[0].address, 'new_address')
+        self.assertEqual(searches[0].lat, 42.3292493)
+        self.assertEqual(len(searches[0].results), 2)
+
+    def test_geocode_cache(self):
+        """Do stored coords come back for the same address"""
+
+        coords = {'lat': 42.3292493, 'lng': -71.352353}
+        GeocodeCache.store('101 Loker St', coords)
+
+        hits = cache_stats['geocode']['hits']
+        self.assertEqual(GeocodeCache.lookup('  101 loker   st'), coords)
+        self.assertEqual(cache_stats['geocode']['hits'], hits + 1)
 
-    def test_sort_searches(self):
-        """Given a user can we sort their searches by unique address/radius"""   
+        misses = cache_stats['geocode']['misses']
+        self.assertIsNone(GeocodeCache.lookup('somewhere else'))
+        self.assertEqual(cache_stats['geocode']['misses'], misses + 1)
 
-        past_searches = Search.query.filter_by(user_id=self.u1.id).limit(1000).all()
-        sorted_searches = Search.sort_searches(past_searches)
-        self.assertEqual(len(sorted_searches), 2)
+    def test_geocode_cache_eviction(self):
+        """Are least recently used addresses evicted first"""
 
-        past_searches = Search.query.filter_by(user_id=self.u2.id).limit(1000).all()
-        sorted_searches = Search.sort_searches(past_searches)
-        self.assertEqual(len(sorted_searches), 0)
+        GeocodeCache.store('first address', {'lat': 1, 'lng': 1})
+        GeocodeCache.store('second address', {'lat': 2, 'lng': 2})
+        GeocodeCache.evict(max_entries=1)
 
+        self.assertIsNone(GeocodeCache.lookup('first address'))
+        self.assertEqual(GeocodeCache.lookup('second address'), {'lat': 2, 'lng': 2})
@@ -8,9 +8,12 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
 from user import db, User
-from search import Search
+from search import Search, SearchResult
+from throttle import login_throttle
+import upstream
 
 os.environ['DATABASE_URL'] = "postgresql:///weather_test"
 
@@ -29,6 +32,7 @@ class SearchViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        login_throttle.store.clear()
 
         self.client = app.test_client()
 
@@ -54,13 +58,13 @@ class SearchViewTestCase(TestCase):
         self.u2 = u2
         self.uid2 = uid2
 
-        s1 = Search(user_id=u1.id, name='hike_name', address='hike_address',
-                    radius='5000', place_id='place_id1', timestamp=None)
+        s1 = Search(user_id=u1.id, address='hike_address', radius='5000', timestamp=None,
+                    results=[SearchResult(name='hike_name', place_id='place_id1')])
         sid1 = 1111
         s1.id = sid1
 
-        s2 = Search(user_id=u1.id, name='hike_name2', address='hike_address2',
-                    radius='5000', place_id='place_id1', timestamp=None)
+        s2 = Search(user_id=u1.id, address='hike_address2', radius='5000', timestamp=None,
+                    results=[SearchResult(name='hike_name2', place_id='place_id1')])
         sid2 = 2222
         s2.id = sid2
 
@@ -101,6 +105,34 @@ class SearchViewTestCase(TestCase):
             self.assertIn('5 day forecast', html)
 
 
+    def test_find_hikes_upstream_down(self):
+        """Is an unreachable Google a flash message instead of a 500"""
+
+        with self.client as c:
+            c.post("/login", data={
+                'username': 'testuser1',
+                'password': 'password1'
+            })
+
+            with patch('upstream.fetch_json', return_value=upstream.error_payload('down')):
+                resp = c.post('/search', data={
+                    'address': '101 loker st unreachable',
+                    'radius': 5000
+                })
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('Could not look up that address', resp.get_data(as_text=True))
+
+                json_resp = c.get('/search/details', query_string={
+                    'origin_address': '101 loker st unreachable',
+                    'destination_id': 'ChIJVxwHDsyF44kR2sqNCPwrBYk'
+                })
+                self.assertEqual(json_resp.status_code, 502)
+                self.assertEqual(json_resp.get_json()['status'], upstream.UPSTREAM_ERROR)
+
+                json_resp = c.get('/search/forecast', query_string={'lat': 1.5, 'lng': 1.5})
+                self.assertEqual(json_resp.status_code, 502)
+
     def test_return_directions(self):
         """When receiving data from front-end can we display directions"""
 
@@ -127,9 +159,37 @@ class SearchViewTestCase(TestCase):
             })
 
             html = json_resp.get_data(as_text=True)
-            self.assertIn('place_id', html)
+            self.assertIn('steps', html)
             # We are getting back correct json response
             
+    def test_return_directions_batch(self):
+        """Can we get directions to many hikes in one request"""
+
+        with self.client as c:
+            json_resp = c.post('/search/details/batch', json={
+                'origin_address': '101 loker st',
+                'destination_ids': ['ChIJVxwHDsyF44kR2sqNCPwrBYk']
+            })
+            self.assertEqual(json_resp.status_code, 302)
+            # logged out users can't run up Directions calls
+
+            c.post("/login", data={
+                'username': 'testuser1',
+                'password': 'password1'
+            })
+
+            json_resp = c.post('/search/details/batch', json={
+                'origin_address': '101 loker st',
+                'destination_ids': ['ChIJVxwHDsyF44kR2sqNCPwrBYk', 'not_a_place_id']
+            })
+
+            data = json_resp.get_json()
+            self.assertIn('steps', data['results']['ChIJVxwHDsyF44kR2sqNCPwrBYk'])
+            self.assertIn('not_a_place_id', data['errors'])
+
+            json_resp = c.post('/search/details/batch', json={'origin_address': '101 loker st'})
+            self.assertEqual(json_resp.status_code, 400)
+
     def test_return_forecast(self):
         """When receiving data from front-end can we display forecast"""
 
@@ -150,12 +210,24 @@ class SearchViewTestCase(TestCase):
             self.assertIn('5 day forecast', html)
 
             json_resp = c.post('/search/forecast', json={
-                'coords':"{'lat': 42.3292493, 'lng': -71.352353}"
+                'lat': 42.3292493, 'lng': -71.352353
             })
 
             html = json_resp.get_data(as_text=True)
             self.assertIn('city', html)
 
+    def test_return_forecast_bad_coords(self):
+        """Is malformed input rejected before calling OpenWeather"""
+
+        with self.client as c:
+            for body in [{'coords': "{'lat': 42.3, 'lng': -71.3}"},
+                         {'lat': '42.3', 'lng': -71.3},
+                         {'lat': 91, 'lng': -71.3},
+                         {'lat': 42.3}]:
+                resp = c.post('/search/forecast', json=body)
+                self.assertEqual(resp.status_code, 400)
+                self.assertIn('error', resp.get_json())
+
 
 
 
@@ -174,6 +246,30 @@ class SearchViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertIn('hike_address', html)
 
+    def test_past_searches_conditional(self):
+        """Does an unchanged history page come back as a 304"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            resp = c.get('/search/past')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNotNone(resp.headers.get('Last-Modified'))
+
+            resp = c.get('/search/past', headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_past_searches_gzip(self):
+        """Is history page compressed when the browser accepts gzip"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            resp = c.get('/search/past', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.headers.get('Content-Encoding'), 'gzip')
+
     def test_search_again(self):
         """Do forms autofill when searching again"""
 
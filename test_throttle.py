@@ -0,0 +1,79 @@
+"""Login throttle tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_throttle.py
+
+
+
+from unittest import TestCase
+from unittest.mock import patch
+from throttle import LoginThrottle, MemoryBucketStore
+
+
+class MemoryBucketStoreTestCase(TestCase):
+    """Test token buckets."""
+
+    def setUp(self):
+        self.store = MemoryBucketStore()
+
+    def test_burst(self):
+        """Can a bucket be emptied then refuse"""
+
+        for i in range(3):
+            self.assertTrue(self.store.take('key', 3, 60, now=1000))
+
+        self.assertFalse(self.store.take('key', 3, 60, now=1000))
+
+    def test_refill(self):
+        """Do tokens come back over time"""
+
+        for i in range(3):
+            self.store.take('key', 3, 60, now=1000)
+
+        self.assertFalse(self.store.take('key', 3, 60, now=1000.5))
+        self.assertTrue(self.store.take('key', 3, 60, now=1001.5))
+        # 60 a minute is one a second
+
+
+class LoginThrottleTestCase(TestCase):
+    """Test ip/username limits."""
+
+    def test_username_limit(self):
+        """Is a username throttled across different ips"""
+
+        throttle = LoginThrottle(MemoryBucketStore())
+
+        with patch('throttle.USER_BURST', 2), patch('throttle.USER_PER_MINUTE', 0):
+            self.assertTrue(throttle.allow('1.1.1.1', 'testuser1'))
+            self.assertTrue(throttle.allow('2.2.2.2', 'TestUser1'))
+            self.assertFalse(throttle.allow('3.3.3.3', 'testuser1'))
+            self.assertTrue(throttle.allow('3.3.3.3', 'testuser2'))
+
+    def test_ip_limit(self):
+        """Is one ip throttled across different usernames"""
+
+        throttle = LoginThrottle(MemoryBucketStore())
+
+        with patch('throttle.IP_BURST', 2), patch('throttle.IP_PER_MINUTE', 0):
+            self.assertTrue(throttle.allow('1.1.1.1', 'a'))
+            self.assertTrue(throttle.allow('1.1.1.1', 'b'))
+            self.assertFalse(throttle.allow('1.1.1.1', 'c'))
+            self.assertTrue(throttle.allow('2.2.2.2', 'c'))
+
+    def test_sweep(self):
+        """Are buckets dropped once they've refilled"""
+
+        store = MemoryBucketStore()
+
+        with patch('throttle.IP_BURST', 2), patch('throttle.IP_PER_MINUTE', 60), \
+                patch('throttle.USER_BURST', 2), patch('throttle.USER_PER_MINUTE', 60), \
+                patch('throttle.SWEEP_INTERVAL', 10):
+            store.take('ip:1.1.1.1', 2, 60, now=1000)
+            store.take('ip:2.2.2.2', 2, 60, now=1000)
+            store.take('ip:3.3.3.3', 2, 60, now=1009)
+            self.assertEqual(len(store.buckets), 3)
+
+            store.take('ip:4.4.4.4', 2, 60, now=1010)
+            # 2 tokens at one a second, the first two are full again
+            self.assertEqual(set(store.buckets), {'ip:3.3.3.3', 'ip:4.4.4.4'})
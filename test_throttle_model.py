@@ -0,0 +1,83 @@
+"""Login bucket table tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_throttle_model.py
+
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from user import db
+from throttle import DatabaseBucketStore, LoginBucket, LoginThrottle
+
+os.environ['DATABASE_URL'] = "postgresql:///weather_test"
+from app import app
+
+
+
+db.create_all()
+
+class DatabaseBucketStoreTestCase(TestCase):
+    """Test token buckets shared through the login_buckets table."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.store = DatabaseBucketStore()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_burst(self):
+        """Can a bucket be emptied then refuse"""
+
+        for i in range(3):
+            self.assertTrue(self.store.take('key', 3, 60, now=1000))
+
+        self.assertFalse(self.store.take('key', 3, 60, now=1000))
+        self.assertEqual(LoginBucket.query.get('key').tokens, 0)
+
+    def test_refill(self):
+        """Do tokens come back over time"""
+
+        for i in range(3):
+            self.store.take('key', 3, 60, now=1000)
+
+        self.assertFalse(self.store.take('key', 3, 60, now=1000.5))
+        self.assertTrue(self.store.take('key', 3, 60, now=1001.5))
+        self.assertAlmostEqual(LoginBucket.query.get('key').tokens, 0.5)
+
+    def test_shared(self):
+        """Do two stores (two workers) draw from the same bucket"""
+
+        other = DatabaseBucketStore()
+
+        self.assertTrue(self.store.take('key', 2, 0, now=1000))
+        self.assertTrue(other.take('key', 2, 0, now=1000))
+        self.assertFalse(self.store.take('key', 2, 0, now=1000))
+
+    def test_sweep(self):
+        """Are idle rows deleted once they've refilled"""
+
+        with patch('throttle.IP_BURST', 2), patch('throttle.IP_PER_MINUTE', 60), \
+                patch('throttle.USER_BURST', 2), patch('throttle.USER_PER_MINUTE', 60), \
+                patch('throttle.SWEEP_INTERVAL', 10):
+            self.store.take('ip:1.1.1.1', 2, 60, now=1000)
+            self.store.take('ip:2.2.2.2', 2, 60, now=1009)
+            self.store.take('ip:3.3.3.3', 2, 60, now=1010)
+
+        keys = {bucket.key for bucket in LoginBucket.query.all()}
+        self.assertEqual(keys, {'ip:2.2.2.2', 'ip:3.3.3.3'})
+
+    def test_login_throttle(self):
+        """Is a username throttled across ips through the table"""
+
+        throttle = LoginThrottle(self.store)
+
+        with patch('throttle.USER_BURST', 2), patch('throttle.USER_PER_MINUTE', 0):
+            self.assertTrue(throttle.allow('1.1.1.1', 'testuser1'))
+            self.assertTrue(throttle.allow('2.2.2.2', 'TestUser1'))
+            self.assertFalse(throttle.allow('3.3.3.3', 'testuser1'))
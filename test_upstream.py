@@ -0,0 +1,176 @@
+"""Upstream client tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_upstream.py
+
+
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from search import Search, SearchResult
+import requests
+import threading
+import time
+import upstream
+
+
+class UpstreamTestCase(TestCase):
+    """Test shared http client."""
+
+    def test_session_reused(self):
+        """Is one pooled session shared by every call in a worker"""
+
+        self.assertIs(upstream.get_session(), upstream.get_session())
+
+    def test_new_session_after_fork(self):
+        """Does a forked worker get its own session"""
+
+        session = upstream.get_session()
+
+        with patch('upstream.os.getpid', return_value=-1):
+            self.assertIsNot(upstream.get_session(), session)
+
+    def test_single_flight(self):
+        """Do concurrent identical calls share one upstream request"""
+
+        calls = []
+        release = threading.Event()
+
+        def slow_fetch(endpoint, url, params):
+            calls.append(url)
+            release.wait(1)
+            return {'status': 'OK'}
+
+        deduplicated = upstream.upstream_stats['deduplicated']
+        results = []
+
+        with patch('upstream.fetch_json', side_effect=slow_fetch):
+            threads = [threading.Thread(target=lambda: results.append(
+                upstream.get_json('geocode', 'http://test', {'address': 'a'})))
+                for i in range(3)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'status': 'OK'}] * 3)
+        self.assertEqual(upstream.upstream_stats['deduplicated'], deduplicated + 2)
+
+    def test_endpoint_timeout(self):
+        """Are per-endpoint timeouts passed to requests"""
+
+        fake_session = MagicMock()
+        fake_session.get.return_value.status_code = 200
+        fake_session.get.return_value.json.return_value = {'status': 'OK'}
+
+        with patch('upstream.get_session', return_value=fake_session):
+            data = upstream.get_json('forecast', 'http://test', {'lat': 1})
+
+        self.assertEqual(data, {'status': 'OK'})
+        fake_session.get.assert_called_with(
+            'http://test', params={'lat': 1}, timeout=upstream.TIMEOUTS['forecast'])
+
+    def test_upstream_failures(self):
+        """Are timeouts, refused connections, 5xx and non-json bodies error payloads"""
+
+        fake_session = MagicMock()
+        broken = MagicMock(status_code=200)
+        broken.json.side_effect = ValueError('Expecting value')
+
+        for outcome in (requests.Timeout(), requests.ConnectionError(),
+                        MagicMock(status_code=503), broken):
+            if isinstance(outcome, Exception):
+                fake_session.get.side_effect = outcome
+            else:
+                fake_session.get.side_effect = None
+                fake_session.get.return_value = outcome
+
+            with patch('upstream.get_session', return_value=fake_session):
+                data = upstream.get_json('directions', 'http://test', {'origin': 'a'})
+
+            self.assertTrue(upstream.is_error(data))
+            self.assertNotEqual(str(data['cod']), '200')
+
+        with patch('upstream.get_session', return_value=fake_session), \
+                patch('search.GeocodeCache.lookup', return_value=None), \
+                patch('search.GeocodeCache.store') as store:
+            self.assertIsNone(Search.get_coords('101 loker st unreachable'))
+        store.assert_not_called()
+
+
+class PrefetchTestCase(TestCase):
+    """Test concurrent prefetch for /search."""
+
+    def setUp(self):
+        self.hikes = [SearchResult(name='hike1', place_id='p1'),
+                      SearchResult(name='hike2', place_id='p2')]
+
+    def test_prefetch(self):
+        """Are forecast and route summaries returned for top hikes"""
+
+        directions = {'distance': '5 mi', 'duration': '10 mins', 'steps': []}
+
+        with patch.object(Search, 'get_forecast', return_value={'cod': '200'}), \
+                patch.object(Search, 'get_directions', return_value=directions) as mock_dir:
+            result = Search.prefetch({'lat': 1, 'lng': 1}, '101 loker st', self.hikes, top_n=1)
+
+        self.assertEqual(result['forecast'], {'cod': '200'})
+        self.assertEqual(result['routes'], {'p1': {'distance': '5 mi', 'duration': '10 mins'}})
+        mock_dir.assert_called_once_with('101 loker st', 'p1')
+
+    def test_prefetch_deadline(self):
+        """Does a slow upstream get left out instead of holding the page"""
+
+        def slow_forecast(coords):
+            time.sleep(0.5)
+            return {'cod': '200'}
+
+        with patch.object(Search, 'get_forecast', side_effect=slow_forecast), \
+                patch.object(Search, 'get_directions', return_value={}):
+            result = Search.prefetch({'lat': 1, 'lng': 1}, 'addr', self.hikes, deadline=0.05)
+
+        self.assertIsNone(result['forecast'])
+        self.assertEqual(result['routes'], {})
+
+    def test_directions_batch(self):
+        """Are per-hike failures reported without failing the batch"""
+
+        def fake_directions(origin, place_id):
+            if place_id == 'bad':
+                raise ConnectionError()
+            if place_id == 'none':
+                return {'status': 'ZERO_RESULTS'}
+            return {'distance': '5 mi', 'duration': '10 mins', 'steps': []}
+
+        with patch.object(Search, 'get_directions', side_effect=fake_directions):
+            results, errors = Search.get_directions_batch('addr', ['p1', 'bad', 'none', 'p1'])
+
+        self.assertEqual(list(results), ['p1'])
+        self.assertEqual(errors, {'bad': 'upstream request failed', 'none': 'ZERO_RESULTS'})
+
+    def test_directions_batch_deadline(self):
+        """Are hikes still queued at the deadline cancelled instead of left on the pool"""
+
+        calls = []
+
+        def slow_directions(origin, place_id):
+            calls.append(place_id)
+            time.sleep(0.2)
+            return {'distance': '5 mi', 'duration': '10 mins', 'steps': []}
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+
+        with patch.object(Search, 'get_directions', side_effect=slow_directions), \
+                patch('upstream.get_executor', return_value=executor):
+            results, errors = Search.get_directions_batch('addr', ['p1', 'p2', 'p3'], deadline=0.05)
+            executor.shutdown(wait=True)
+
+        self.assertEqual(results, {})
+        self.assertEqual(errors, {'p1': 'timed out', 'p2': 'timed out', 'p3': 'timed out'})
+        self.assertEqual(calls, ['p1'])
@@ -8,8 +8,10 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 from sqlalchemy import exc
-from user import db, User
+from user import db, User, BCRYPT_LOG_ROUNDS
+from identity import CurrentUser, forget_user, identity_cache
 
 os.environ['DATABASE_URL'] = "postgresql:///weather_test"
 from app import app
@@ -117,6 +119,95 @@ class UserModelTestCase(TestCase):
         self.assertIsInstance(user, User)   
 
 
+    def test_rehash_on_login(self):
+        """Tests that hashes made at an old cost are upgraded at login"""
+
+        self.u1.password = User.hash_password('password1', rounds=4)
+        db.session.commit()
+        self.assertTrue(self.u1.needs_rehash())
+
+        user = User.authenticate('testuser1', 'password1')
+        self.assertEqual(User.hash_cost(user.password), BCRYPT_LOG_ROUNDS)
+        self.assertFalse(user.needs_rehash())
+        self.assertTrue(User.authenticate('testuser1', 'password1'))
+
+    def test_admin_listing(self):
+        """Tests that admin panel pages through non-admin users with only listed columns"""
+
+        u3 = User.register("testuser3", "password3", "Sarah", "Parker", "email3@test.com", False)
+        u3.id = 3333
+        db.session.add(u3)
+        db.session.commit()
+
+        listing = User.admin_listing(per_page=1)
+        self.assertEqual(listing['total'], 2)
+        # testuser1 is an admin
+        self.assertEqual(listing['users'][0].username, 'testuser2')
+        self.assertFalse(hasattr(listing['users'][0], 'password'))
+        self.assertEqual(listing['next'], 2222)
+
+        listing = User.admin_listing(per_page=1, after_id=listing['next'])
+        self.assertEqual(listing['users'][0].username, 'testuser3')
+        self.assertIsNone(listing['next'])
+
+        listing = User.admin_listing(prefix='email2')
+        self.assertEqual(listing['total'], 1)
+        self.assertEqual(listing['users'][0].id, 2222)
+
+        self.assertEqual(User.admin_listing(prefix='email1')['total'], 0)
+
+    def test_admin_listing_estimate(self):
+        """Tests that the unfiltered admin total comes from the row estimate on big tables"""
+
+        self.assertIsNone(User.estimated_count())
+        self.assertFalse(User.admin_listing()['estimated'])
+        # two users, counted exactly
+
+        with patch.object(User, 'estimated_count', return_value=50000):
+            listing = User.admin_listing()
+            self.assertTrue(listing['estimated'])
+            self.assertEqual(listing['total'], 49999)
+            # testuser1 is an admin
+
+            listing = User.admin_listing(prefix='email2')
+            self.assertFalse(listing['estimated'])
+            self.assertEqual(listing['total'], 1)
+
+
+    def test_current_user(self):
+        """Tests that g.user stand-in serves identity fields from the cache"""
+
+        identity_cache.clear()
+        current = CurrentUser(self.uid1)
+        self.assertTrue(current)
+        self.assertEqual(current.username, 'testuser1')
+        self.assertIsNotNone(identity_cache.get(self.uid1))
+
+        self.u1.edit_user('new_name', 'Bobby', 'Jones', 'new_email@gmail.com')
+        forget_user(self.uid1)
+        self.assertEqual(CurrentUser(self.uid1).username, 'new_name')
+
+        self.assertFalse(CurrentUser(9999))
+        # missing user acts like being logged out
+
+    def test_current_user_deleted_elsewhere(self):
+        """Tests that a cached identity for a deleted account doesn't keep it logged in"""
+
+        identity_cache.clear()
+        self.assertTrue(CurrentUser(self.uid1))
+
+        db.session.delete(self.u1)
+        db.session.commit()
+        # deleted without forget_user, like another worker did it
+
+        current = CurrentUser(self.uid1)
+        self.assertTrue(current)
+        # still cached
+        self.assertIsNone(current.load())
+        self.assertFalse(current)
+        self.assertIsNone(identity_cache.get(self.uid1))
+
+
     #test failure cases ###################################### 
 
     def test_auth_username_fail(self):
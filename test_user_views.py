@@ -8,10 +8,13 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
 from flask import session
 from user import db, connect_db, User
-from search import Search
+from search import Search, SearchResult
+from throttle import login_throttle
+from hashing import HashQueueFull
 
 os.environ['DATABASE_URL'] = "postgresql:///weather_test"
 
@@ -29,6 +32,7 @@ class UserViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        login_throttle.store.clear()
 
         self.client = app.test_client()
 
@@ -52,13 +56,13 @@ class UserViewTestCase(TestCase):
         self.u2 = u2
         self.uid2 = uid2
 
-        s1 = Search(user_id=u1.id, name='hike_name', address='hike_address',
-                                 radius='5000', place_id='place_id1', timestamp=None)
+        s1 = Search(user_id=u1.id, address='hike_address', radius='5000', timestamp=None,
+                    results=[SearchResult(name='hike_name', place_id='place_id1')])
         sid1 = 1111
         s1.id = sid1     
 
-        s2 = Search(user_id=u1.id, name='hike_name2', address='hike_address2',
-                                 radius='5000', place_id='place_id1', timestamp=None)
+        s2 = Search(user_id=u1.id, address='hike_address2', radius='5000', timestamp=None,
+                    results=[SearchResult(name='hike_name2', place_id='place_id1')])
         sid2 = 2222
         s2.id = sid2  
 
@@ -232,6 +236,24 @@ class UserViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertIn('Field must be at least 6 characters long', html)            
 
+    def test_register_hashing_busy(self):
+        """Tests that a full hashing queue says try again, not username taken"""
+
+        with self.client as c:
+            with patch('user.hashing.generate_password_hash', side_effect=HashQueueFull):
+                resp = c.post("/register", data={
+                    'username': 'Billy',
+                    'password': 'billy758',
+                    'email': 'billy@gmail.com',
+                    'first_name': 'Billy',
+                    'last_name': 'Jones'
+                })
+
+            self.assertEqual(resp.status_code, 303)
+            html = c.get('/register').get_data(as_text=True)
+            self.assertIn('please try again in a moment', html)
+            self.assertNotIn('Username or email already taken', html)
+
     def test_login_bad_credentials(self):
         """Tests that we cant login with bad credentials"""
 
@@ -243,7 +265,27 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             html = resp.get_data(as_text=True)
-            self.assertIn('Invalid username/password', html)  
+            self.assertIn('Invalid username/password', html)
+
+    def test_login_throttled(self):
+        """Tests that a throttled login is a 429 and never checks the password"""
+
+        with self.client as c:
+            with patch('throttle.USER_BURST', 2), patch('throttle.USER_PER_MINUTE', 0), \
+                    patch('user.hashing.check_password_hash', return_value=False) as check:
+                for i in range(2):
+                    c.post("/login", data={'username': 'testuser1', 'password': 'wrong1'})
+                self.assertEqual(check.call_count, 2)
+
+                resp = c.post("/login", data={
+                    'username': 'testuser1',
+                    'password': 'password1'
+                })
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(check.call_count, 2)
+            self.assertIn('Too many attempts', resp.get_data(as_text=True))
+            self.assertEqual(session.get(CURR_USER_KEY), None)
 
     def test_display_profile(self):
         """While logged in, can we display profile"""     
@@ -0,0 +1,187 @@
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from user import db
+import os
+import threading
+import time
+
+
+THROTTLE_BACKEND = os.environ.get('THROTTLE_BACKEND', 'memory')
+# 'memory' is per worker, 'database' shares buckets across every worker
+
+IP_BURST = int(os.environ.get('LOGIN_IP_BURST', 20))
+IP_PER_MINUTE = float(os.environ.get('LOGIN_IP_PER_MINUTE', 10))
+USER_BURST = int(os.environ.get('LOGIN_USER_BURST', 5))
+USER_PER_MINUTE = float(os.environ.get('LOGIN_USER_PER_MINUTE', 3))
+# a bucket holds BURST tokens, refills PER_MINUTE tokens a minute and
+# every password attempt costs one token from both the ip and username bucket
+
+SWEEP_INTERVAL = float(os.environ.get('LOGIN_BUCKET_SWEEP_INTERVAL', 60))
+# seconds between dropping buckets that have refilled, a full bucket is the
+# same as no bucket so rotating ips/usernames can't grow the store for good
+
+throttle_stats = {'allowed': 0, 'throttled': 0, 'swept': 0}
+
+
+def refill(tokens, updated_at, now, capacity, per_minute):
+    """Returns token count after refilling since updated_at"""
+
+    return min(capacity, tokens + (now - updated_at) * per_minute / 60)
+
+
+def idle_seconds():
+    """Seconds after which any untouched bucket is full again, None if never"""
+
+    if IP_PER_MINUTE <= 0 or USER_PER_MINUTE <= 0:
+        return None
+
+    return max(IP_BURST * 60 / IP_PER_MINUTE, USER_BURST * 60 / USER_PER_MINUTE)
+
+
+class LoginBucket(db.Model):
+    """Token bucket state shared by every worker"""
+
+    __tablename__ = 'login_buckets'
+
+    key = db.Column(db.Text, primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False, index=True)
+    # indexed for the sweep of idle rows
+
+
+class MemoryBucketStore:
+    """Buckets kept in this worker's memory"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.swept_at = 0
+
+    def take(self, key, capacity, per_minute, now=None):
+        """Takes a token from key's bucket, False if it's empty"""
+
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            self.sweep(now)
+
+            tokens, updated_at = self.buckets.get(key, (capacity, now))
+            tokens = refill(tokens, updated_at, now, capacity, per_minute)
+
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return False
+
+            self.buckets[key] = (tokens - 1, now)
+            return True
+
+    def sweep(self, now):
+        """Drops buckets idle long enough to be full, caller holds the lock"""
+
+        idle = idle_seconds()
+        if idle is None or now - self.swept_at < SWEEP_INTERVAL:
+            return
+
+        self.swept_at = now
+        stale = [key for key, (tokens, updated_at) in self.buckets.items()
+                 if updated_at < now - idle]
+        for key in stale:
+            del self.buckets[key]
+
+        throttle_stats['swept'] += len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class DatabaseBucketStore:
+    """Buckets in the login_buckets table, row locks keep workers consistent"""
+
+    def __init__(self):
+        self.swept_at = 0
+
+    def take(self, key, capacity, per_minute, now=None):
+        """Takes a token from key's bucket, False if it's empty
+
+        One UPDATE when the bucket has a token, an INSERT as well for a new
+        key, empty buckets aren't written to"""
+
+        if now is None:
+            now = time.time()
+
+        self.sweep(now)
+
+        table = LoginBucket.__table__
+        tokens = func.least(capacity,
+                            table.c.tokens + (now - table.c.updated_at) * (per_minute / 60))
+
+        take = (table.update()
+                .where(table.c.key == key)
+                .where(tokens >= 1)
+                .values(tokens=tokens - 1, updated_at=now)
+                .returning(table.c.key))
+        create = (insert(table)
+                  .values(key=key, tokens=capacity - 1, updated_at=now)
+                  .on_conflict_do_nothing(index_elements=['key'])
+                  .returning(table.c.key))
+
+        with db.engine.begin() as conn:
+            # own connection/transaction so the request's session isn't committed
+            allowed = (conn.execute(take).first() is not None
+                       or conn.execute(create).first() is not None
+                       or conn.execute(take).first() is not None)
+            # the second take is for a key another worker created in between
+
+        return allowed
+
+    def sweep(self, now):
+        """Deletes rows idle long enough to be full, at most once a SWEEP_INTERVAL"""
+
+        idle = idle_seconds()
+        if idle is None or now - self.swept_at < SWEEP_INTERVAL:
+            return
+
+        self.swept_at = now
+        table = LoginBucket.__table__
+
+        with db.engine.begin() as conn:
+            result = conn.execute(table.delete().where(table.c.updated_at < now - idle))
+
+        throttle_stats['swept'] += result.rowcount
+
+    def clear(self):
+        with db.engine.begin() as conn:
+            conn.execute(LoginBucket.__table__.delete())
+
+
+class LoginThrottle:
+    """Caps password attempts per client ip and per username"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def allow(self, ip, username):
+        """Charges one attempt to ip and username, False if either is out of budget"""
+
+        allowed = self.store.take(f'ip:{ip}', IP_BURST, IP_PER_MINUTE)
+
+        if allowed and username:
+            allowed = self.store.take(f'user:{username.lower()}', USER_BURST, USER_PER_MINUTE)
+
+        throttle_stats['allowed' if allowed else 'throttled'] += 1
+        return allowed
+
+
+def make_store(backend=None):
+    if backend is None:
+        backend = THROTTLE_BACKEND
+
+    if backend == 'database':
+        return DatabaseBucketStore()
+
+    return MemoryBucketStore()
+
+
+login_throttle = LoginThrottle(make_store())
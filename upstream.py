@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import os
+import requests
+import threading
+
+
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 10))
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))
+UPSTREAM_BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', 0.3))
+# waits 0.3s, 0.6s ... between retries
+UPSTREAM_WORKERS = int(os.environ.get('UPSTREAM_WORKERS', 4))
+# threads per worker for fanning out upstream calls
+
+TIMEOUTS = {
+    # (connect, read) seconds, a slow upstream must never hold a worker forever
+    'geocode': (3.05, 5),
+    'places': (3.05, 10),
+    'directions': (3.05, 10),
+    'forecast': (3.05, 5),
+}
+DEFAULT_TIMEOUT = (3.05, 10)
+
+UPSTREAM_ERROR = 'UPSTREAM_ERROR'
+# status of a call that never got a usable answer (timeout, refused, 5xx, not json)
+
+upstream_stats = {'requests': 0, 'deduplicated': 0, 'errors': 0}
+
+_session = None
+_session_pid = None
+_executor = None
+_executor_pid = None
+
+
+def make_session():
+    """Creates a pooled keep-alive session with bounded retries"""
+
+    retry = Retry(total=UPSTREAM_RETRIES, connect=UPSTREAM_RETRIES, read=UPSTREAM_RETRIES,
+                  backoff_factor=UPSTREAM_BACKOFF,
+                  status_forcelist=(500, 502, 503, 504),
+                  raise_on_status=False)
+    # only GETs are retried (urllib3 default), they're all idempotent lookups
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=UPSTREAM_POOL_SIZE,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def get_session():
+    """Returns this worker's session, a new one after gunicorn forks"""
+
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        # sockets can't be shared across forked workers
+        _session = make_session()
+        _session_pid = os.getpid()
+
+    return _session
+
+
+def get_executor():
+    """Returns this worker's bounded thread pool for concurrent upstream calls"""
+
+    global _executor, _executor_pid
+
+    if _executor is None or _executor_pid != os.getpid():
+        # threads don't survive a fork, each worker needs its own pool
+        _executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS,
+                                       thread_name_prefix='upstream')
+        _executor_pid = os.getpid()
+
+    return _executor
+
+
+class SingleFlight:
+    """Lets concurrent identical calls share one in-flight call and its result"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        # key -> {'done': Event, 'result': ..., 'error': ...}
+
+    def do(self, key, func, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self.calls[key] = call
+                upstream_stats['requests'] += 1
+            else:
+                upstream_stats['deduplicated'] += 1
+
+        if not leader:
+            # upstream timeouts bound how long the leader can take
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func(*args)
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+        return call['result']
+
+
+single_flight = SingleFlight()
+
+
+def error_payload(message):
+    """A failed call shaped like both APIs' own errors
+
+    Google callers check status and OpenWeather callers check cod, so it's
+    never cached or parsed as results"""
+
+    return {'status': UPSTREAM_ERROR, 'cod': '502', 'message': message,
+            'error_message': message}
+
+
+def is_error(data):
+    return data.get('status') == UPSTREAM_ERROR
+
+
+def fetch_json(endpoint, url, params):
+    """Does the actual GET with the endpoint's timeouts
+
+    Never raises for upstream problems, returns error_payload instead"""
+
+    timeout = TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+
+    try:
+        response = get_session().get(url, params=params, timeout=timeout)
+        if response.status_code >= 500:
+            # still failing after the retries
+            upstream_stats['errors'] += 1
+            return error_payload(f'{endpoint} returned {response.status_code}')
+        return response.json()
+    except requests.RequestException:
+        upstream_stats['errors'] += 1
+        return error_payload(f'{endpoint} request failed')
+    except ValueError:
+        upstream_stats['errors'] += 1
+        return error_payload(f'{endpoint} returned a non-json response')
+
+
+def get_json(endpoint, url, params):
+    """GETs url through the shared session and returns parsed json
+
+    Identical calls already in flight in this worker share that call"""
+
+    key = (url, tuple(sorted((name, str(value)) for name, value in params.items())))
+
+    return single_flight.do(key, fetch_json, endpoint, url, params)
@@ -1,11 +1,18 @@
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+from sqlalchemy import func, or_
+import hashing
+import os
 
 
 
 db = SQLAlchemy()
 
-bcrypt = Bcrypt()
+BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# each +1 doubles hashing cost, existing hashes are upgraded/downgraded on login
+
+ADMIN_COUNT_ESTIMATE_OVER = int(os.environ.get('ADMIN_COUNT_ESTIMATE_OVER', 10000))
+# past this many users the admin panel's unfiltered total is the planner's
+# row estimate, counting it exactly scans the whole table on every page load
 
 
 def connect_db(app):
@@ -17,6 +24,15 @@ class User(db.Model):
     """User model"""
 
     __tablename__ = "users"
+    __table_args__ = (
+        db.Index('ix_users_username_prefix', 'username',
+                 postgresql_ops={'username': 'varchar_pattern_ops'}),
+        db.Index('ix_users_email_prefix', 'email',
+                 postgresql_ops={'email': 'varchar_pattern_ops'}),
+        # pattern_ops lets LIKE 'abc%' use the index regardless of collation
+        db.Index('ix_users_admins', 'id', postgresql_where=db.text('is_admin')),
+        # admins are few, counting them to take them off the estimate stays cheap
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(20), nullable=False, unique=True)
@@ -31,9 +47,7 @@ class User(db.Model):
     def register(cls, username, password, first_name, last_name, email, is_admin):
         """Register User with hashed password and return user"""
 
-        hashed = bcrypt.generate_password_hash(password)
-
-        hashed_utf8 = hashed.decode("utf8")
+        hashed_utf8 = cls.hash_password(password)
 
         return cls(username=username, password=hashed_utf8, first_name=first_name, last_name=last_name, email=email, is_admin=is_admin)
     # end_register
@@ -46,12 +60,48 @@ class User(db.Model):
 
         user = User.query.filter_by(username=username).first()
 
-        if user and bcrypt.check_password_hash(user.password, pwd):
+        if user and hashing.check_password_hash(user.password, pwd):
+            if user.needs_rehash():
+                user.rehash_password(pwd)
             return user
         else:
             return False
     # end_authenticate
 
+    @classmethod
+    def hash_password(cls, password, rounds=None):
+        """Returns utf8 bcrypt hash using configured cost"""
+
+        if rounds is None:
+            rounds = BCRYPT_LOG_ROUNDS
+
+        return hashing.generate_password_hash(password, rounds)
+        # waits for one of hashing's machine-wide slots so bcrypt can't tie up every worker
+
+    @classmethod
+    def hash_cost(cls, hashed):
+        """Reads the cost out of a hash, '$2b$12$...' -> 12"""
+
+        try:
+            return int(hashed.split('$')[2])
+        except (AttributeError, IndexError, ValueError):
+            return None
+
+    def needs_rehash(self):
+        """True if stored hash was made with a different cost than configured"""
+
+        return self.hash_cost(self.password) != BCRYPT_LOG_ROUNDS
+
+    def rehash_password(self, password):
+        """Re-hashes a just verified password at the configured cost"""
+
+        try:
+            self.password = self.hash_password(password)
+            db.session.commit()
+        except:
+            # login still succeeds, we'll try again next time
+            db.session.rollback()
+
     def edit_user(self, username, first_name, last_name, email):
         """Allows user to edit profile info"""
         self.username = username
@@ -64,17 +114,69 @@ class User(db.Model):
     def check_password(self, entered_password):
         """Checks that user enters correct password"""
 
-        return  bcrypt.check_password_hash(self.password, entered_password)    
+        return hashing.check_password_hash(self.password, entered_password)    
 
     def change_password(self, password):
         """Allows user to change their password"""
 
-        hashed = bcrypt.generate_password_hash(password)
-        hashed_utf8 = hashed.decode("utf8")
-
-        self.password = hashed_utf8
+        self.password = self.hash_password(password)
         db.session.commit()
 
+    @classmethod
+    def admin_listing(cls, per_page=50, after_id=None, prefix=None):
+        """Returns one page of users for the admin panel, only the columns it shows
+
+        Admins can't be deleted from the panel so they're left out of the
+        page and the total"""
+
+        query = db.session.query(cls.id, cls.username, cls.email).filter(cls.is_admin == False)
+        count_query = db.session.query(func.count(cls.id)).filter(cls.is_admin == False)
+
+        if prefix:
+            escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            matches = or_(cls.username.like(f'{escaped}%', escape='\\'),
+                          cls.email.like(f'{escaped}%', escape='\\'))
+            query = query.filter(matches)
+            count_query = count_query.filter(matches)
+
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+
+        users = query.order_by(cls.id).limit(per_page + 1).all()
+        # one extra row tells us whether there's a next page
+
+        estimate = None if prefix else cls.estimated_count()
+        if estimate is not None:
+            admins = db.session.query(func.count(cls.id)).filter(cls.is_admin == True).scalar()
+            total = max(estimate - admins, 0)
+        else:
+            total = count_query.scalar()
+            # prefix searches use the pattern_ops indexes, small tables are cheap anyway
+
+        return {
+            'users': users[:per_page],
+            'next': users[per_page - 1].id if len(users) > per_page else None,
+            'total': total,
+            'estimated': estimate is not None,
+        }
+
+    @classmethod
+    def estimated_count(cls):
+        """Postgres' row estimate for users, None below ADMIN_COUNT_ESTIMATE_OVER
+
+        Kept up to date by autovacuum/analyze, -1 if the table was never analyzed"""
+
+        if db.engine.dialect.name != 'postgresql':
+            return None
+
+        estimate = db.session.execute(db.text(
+            "SELECT reltuples FROM pg_class WHERE oid = 'users'::regclass")).scalar()
+
+        if estimate is None or estimate < ADMIN_COUNT_ESTIMATE_OVER:
+            return None
+
+        return int(estimate)
+
     def __repr__(self):
         return f"<User #{self.id}, username: {self.username}, first_name: {self.first_name}, last_name: {self.last_name}, email: {self.email}, is_admin: {self.is_admin}>"
 